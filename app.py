@@ -1,14 +1,30 @@
+import logging
+import click
 from flask import Flask, request, jsonify, render_template
 from models import db, Book, Review, Genre, Author, UserBooks
 from schemas import BookSchema, ReviewSchema, GenreSchema, AuthorSchema
 from config import Config
-from recommendations import get_recommendations, record_feedback
+from recommendations import get_recommendations, record_feedback, update_taste, get_book_embeddings, build_embedding_store
+from embedding_store import embedding_store_path, open_embedding_store
+from neighbors import build_neighbors, update_neighbors, get_similar_books, DEFAULT_K
+from catalog import get_catalog_version
+from catalog_snapshot import refresh_snapshot
+from genres import backfill_genres
+from ranking_cursor import create_cursor
+import numpy as np
+from taste import get_taste_vector, rebuild_taste_profile
 from routes import api
+from metrics import init_metrics, timed
+from profiling import init_profiling
+from feedback_queue import init_feedback_queue, get_feedback_queue, known_book_ids, rejected_row_ids
 from flask_migrate import Migrate
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+logging.basicConfig(level=app.config['LOG_LEVEL'], format='%(asctime)s %(levelname)s %(name)s %(message)s')
+logger = logging.getLogger('bookhunt')
+
 # Initialize the database
 db.init_app(app)
 
@@ -24,13 +40,25 @@ genre_schema = GenreSchema()
 genres_schema = GenreSchema(many=True)
 author_schema = AuthorSchema()
 
-# Use app context to create tables at startup
+# Use app context to create tables at startup. A database under Flask-Migrate
+# control is left alone: its schema is brought up to date with `flask db upgrade`,
+# and create_all would add new tables ahead of the migrations that build them
 with app.app_context():
-    db.create_all()
+    if not db.inspect(db.engine).has_table('alembic_version'):
+        db.create_all()
 
 # Register the API blueprint
 app.register_blueprint(api)
 
+# Per-request timings (Server-Timing header) and the /metrics endpoint
+init_metrics(app)
+
+# Opt-in request profiling and the slow SQL log
+init_profiling(app)
+
+# Optional write-behind queue for feedback writes
+init_feedback_queue(app)
+
 # API Routes
 @app.route('/api/books', methods=['GET'])
 def get_books():
@@ -39,7 +67,7 @@ def get_books():
 
 @app.route('/api/books/<string:book_id>', methods=['GET'])
 def get_book(book_id):
-    book = Book.query.get_or_404(book_id)
+    book = Book.query.filter_by(id=book_id).first_or_404()
     return book_schema.jsonify(book)
 
 # Reviews Routes
@@ -50,7 +78,8 @@ def add_review():
     rating = data.get('rating')
     comment = data.get('comment', '')
     
-    review = Review(book_id=book_id, rating=rating, comment=comment)
+    book = Book.query.filter_by(id=book_id).first_or_404()
+    review = Review(book_row_id=book.row_id, rating=rating, comment=comment)
     db.session.add(review)
     db.session.commit()
     
@@ -58,7 +87,7 @@ def add_review():
 
 @app.route('/api/reviews/book/<string:book_id>', methods=['GET'])
 def get_reviews(book_id):
-    reviews = Review.query.filter_by(book_id=book_id).all()
+    reviews = Review.query.join(Book, Review.book_row_id == Book.row_id).filter(Book.id == book_id).all()
     return reviews_schema.jsonify(reviews)
 
 # Genres Routes
@@ -70,7 +99,7 @@ def get_genres():
 # Authors Routes
 @app.route('/api/authors/<string:author_id>', methods=['GET'])
 def get_author(author_id):
-    author = Author.query.get_or_404(author_id)
+    author = Author.query.filter_by(id=author_id).first_or_404()
     return author_schema.jsonify(author)
 
 # Book Recommendation Route
@@ -82,14 +111,14 @@ def recommend_books():
         return jsonify({"error": "Query parameter is required"}), 400
 
     user_books = UserBooks.query.filter_by(status="read").all()
-    books = Book.query.all()
     
-    recommended_books = get_recommendations(query, books, user_books, genre)
+    recommended_books = get_recommendations(query, user_books, genre, taste_vector=get_taste_vector())
     
     if not recommended_books:
         return jsonify({"message": "No recommendations found"}), 404
     
-    return books_schema.jsonify(recommended_books)
+    with timed('serialize'):
+        return books_schema.jsonify(recommended_books)
 
 # Feedback Route
 # Feedback Route
@@ -104,23 +133,19 @@ def handle_feedback():
 
     if not book_id or not feedback:
         return jsonify({"error": "Book ID and feedback are required"}), 400
+    if not isinstance(book_id, str) or not isinstance(feedback, str):
+        return jsonify({"error": "Book ID and feedback must be strings"}), 400
 
-    # Record feedback
-    record_feedback(book_id, feedback)
+    # Queue the feedback if write-behind is enabled; it is written in the next batch
+    queue = get_feedback_queue()
+    if queue is not None:
+        if not known_book_ids([book_id]):
+            return jsonify({"error": "Book not found"}), 404
+        queue.submit(book_id, feedback)
+        return jsonify({"message": "Feedback accepted"}), 202
 
-    # If feedback is 'accept', add the book to the reading list
-    if feedback == 'accept':
-        # Check if the book is already in the reading list
-        existing_entry = UserBooks.query.filter_by(book_id=book_id, status="to_read").first()
-        if not existing_entry:
-            # Add the book to the reading list
-            new_entry = UserBooks(
-                book_id=book_id,
-                status="to_read",  # Mark as "to read"
-                opinion=None  # No opinion yet
-            )
-            db.session.add(new_entry)
-            db.session.commit()
+    # Record feedback (accepted books are added to the reading list as "to_read")
+    record_feedback(book_id, feedback)
 
     return jsonify({"message": "Feedback recorded and reading list updated successfully"}), 200
 
@@ -134,7 +159,7 @@ def recommendations_page():
     query = request.args.get('query', '').strip()
     genre = request.args.get('genre', '').strip()
 
-    print(f"Query: {query}, Genre: {genre}")  # For debugging
+    logger.debug('recommendations query=%r genre=%r', query, genre)
 
     # If no query is provided, just show the input form
     if not query:
@@ -142,22 +167,25 @@ def recommendations_page():
 
     # Get past books the user has interacted with
     user_books = UserBooks.query.filter_by(status="read").all()
-    books = Book.query.all()
 
-    # Generate recommendations if query is provided
-    recommended_books = get_recommendations(query, books, user_books, genre)
+    # Generate recommendations if query is provided, keeping the ranking for "next". Rejected
+    # books (pending ones included) are left out, as the cursor skips them for later books
+    recommended_books = get_recommendations(query, user_books, genre,
+                                            app.config['RANKING_CURSOR_DEPTH'], get_taste_vector(),
+                                            excluded_row_ids=rejected_row_ids())
 
     if not recommended_books:
         # Render no recommendations page if no books found
         return render_template('no_recommendations.html', query=query, genre=genre)
 
-    # Debugging: Print the number of recommended books
-    print(f"Number of recommendations: {len(recommended_books)}")
+    logger.debug('recommendations count=%d', len(recommended_books))
 
-    # Pass only the top recommendation (first book in the list)
+    # Pass only the top recommendation (first book in the list); the rest is served from the cursor
     recommended_book = recommended_books[0] if recommended_books else None
+    cursor = create_cursor(query, genre, [book.row_id for book in recommended_books], get_catalog_version(), position=1)
 
-    return render_template('recommendations.html', book=recommended_book, query=query, genre=genre)
+    with timed('serialize'):
+        return render_template('recommendations.html', book=recommended_book, query=query, genre=genre, cursor=cursor)
 
 @app.route('/past_reads', methods=['GET', 'POST'])
 def past_reads_page():
@@ -176,24 +204,26 @@ def past_reads_page():
             return jsonify({"error": "Book not found"}), 404
 
         # Check if the book already exists in the user's past reads
-        existing_user_book = UserBooks.query.filter_by(book_id=book.id, status="read").first()
+        existing_user_book = UserBooks.query.filter_by(book_row_id=book.row_id, status="read").first()
 
         if existing_user_book:
             existing_user_book.opinion = opinion
             db.session.commit()
             return jsonify({"message": "Opinion updated successfully"}), 200
         else:
-            user_book = UserBooks(book_id=book.id, status="read", opinion=opinion)
+            user_book = UserBooks(book_row_id=book.row_id, status="read", opinion=opinion)
             db.session.add(user_book)
+            update_taste(book, None, None, "read", None)
             db.session.commit()
             return jsonify({"message": "Past read added successfully"}), 201
 
     # If it's a GET request, show the past reads
-    user_books = UserBooks.query.filter_by(status="read").all()
+    user_books = (db.session.query(UserBooks, Book)
+                  .join(Book, UserBooks.book_row_id == Book.row_id)
+                  .filter(UserBooks.status == "read").all())
     # Add book title to each user_book
     past_reads = []
-    for user_book in user_books:
-        book = Book.query.get(user_book.book_id)
+    for user_book, book in user_books:
         if book:
             past_reads.append({
                 'book_title': book.title,
@@ -206,11 +236,12 @@ def past_reads_page():
 # Reading List Page
 @app.route('/reading_list', methods=['GET'])
 def reading_list_page():
-    user_books = UserBooks.query.filter_by(status="reading").all()
+    user_books = (db.session.query(UserBooks, Book)
+                  .join(Book, UserBooks.book_row_id == Book.row_id)
+                  .filter(UserBooks.status == "reading").all())
     reading_list = []
     
-    for user_book in user_books:
-        book = db.session.get(Book, user_book.book_id)  # Use Session.get()
+    for user_book, book in user_books:
         if book:
             reading_list.append({
                 'title': book.title,
@@ -222,8 +253,59 @@ def reading_list_page():
 
 @app.route('/book/<string:book_id>', methods=['GET'])
 def book_details(book_id):
-    book = Book.query.get_or_404(book_id)
-    return render_template('book_details.html', book=book)
+    book = Book.query.filter_by(id=book_id).first_or_404()
+    similar_books = get_similar_books(book.row_id)
+    return render_template('book_details.html', book=book, similar_books=similar_books)
+
+@app.cli.command('rebuild-taste')
+def rebuild_taste_command():
+    """Recompute the taste profile from scratch and report drift from the stored one."""
+    agreement, stored_total, rebuilt_total = rebuild_taste_profile(get_book_embeddings)
+    click.echo(f"Stored weight total: {stored_total:.2f}, rebuilt: {rebuilt_total:.2f}")
+    if agreement is not None:
+        click.echo(f"Cosine similarity between stored and rebuilt profile: {agreement:.6f}")
+
+@app.cli.command('build-embeddings')
+@click.option('--batch-size', default=32, show_default=True, help='Books encoded per forward pass.')
+@click.option('--dtype', type=click.Choice(['float32', 'float16']), default='float32', show_default=True)
+@click.option('--incremental', is_flag=True, help='Only encode books missing from the current file.')
+def build_embeddings_command(batch_size, dtype, incremental):
+    """Encode every book and swap in a new embedding file."""
+    books = Book.query.all()
+    path = embedding_store_path(app)
+    encoded = build_embedding_store(path, books, batch_size, np.dtype(dtype), incremental,
+                                    progress=lambda done, total: click.echo(f"Encoded {done}/{total} books"))
+    click.echo(f"Wrote {len(books)} embeddings ({len(encoded)} newly encoded) to {path}")
+
+@app.cli.command('build-catalog-snapshot')
+def build_catalog_snapshot_command():
+    """Rebuild the catalog snapshot from scratch, e.g. after editing existing books."""
+    snapshot = refresh_snapshot(full=True)
+    click.echo(f"Catalog snapshot rebuilt with {len(snapshot)} books at catalog version {snapshot.version}")
+
+@app.cli.command('classify-genres')
+@click.option('--all', 'reclassify_all', is_flag=True, help='Reclassify every book, not only those without a genre.')
+@click.option('--batch-size', default=64, show_default=True, help='Books embedded and scored per batch.')
+def classify_genres_command(reclassify_all, batch_size):
+    """Assign genres from categories, falling back to the nearest genre prototype."""
+    counts = backfill_genres(reclassify_all, batch_size)
+    click.echo(f"Classified {sum(counts.values())} books: {counts['categories']} from categories, "
+               f"{counts['embedding']} by description, {counts['unknown']} unknown")
+
+@app.cli.command('build-neighbors')
+@click.option('--k', default=DEFAULT_K, show_default=True, help='Neighbours stored per book.')
+@click.option('--workers', default=None, type=int, help='Threads used for scoring (default: all cores).')
+@click.option('--row-id', 'row_ids', type=int, multiple=True, help='Only update for these changed book row ids (repeatable).')
+def build_neighbors_command(k, workers, row_ids):
+    """Precompute the similar-books lists from the embedding file."""
+    store = open_embedding_store(embedding_store_path(app))
+    if store is None:
+        raise click.ClickException("No embedding file found; run 'flask build-embeddings' first")
+    if row_ids:
+        count = update_neighbors(store, row_ids, k, workers)
+    else:
+        count = build_neighbors(store, k, workers)
+    click.echo(f"Stored neighbours for {count} books")
 
 #lol
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+"""
+The catalog version counter.
+
+Anything derived from the set of books (ranked result lists, snapshots) is
+tagged with the version it was built from and rebuilt when the version moves
+on. Call bump_catalog_version() in the same transaction that adds or changes
+books, with rebuild=True if existing books were edited or removed: structures
+that only append the newest books on a version change (the catalog snapshot)
+are then rebuilt from scratch.
+
+Edits to the columns the snapshot holds and deletions of existing books are
+also caught on flush, so a change made anywhere bumps the version with
+rebuild=True even if the code making it doesn't.
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Book, CatalogState
+
+# Book columns derived structures read; changing one on an existing book needs a rebuild
+SNAPSHOT_COLUMNS = ('id', 'description', 'number_of_pages', 'subjects', 'genre_row_id')
+
+def get_catalog_version():
+    """Return the current catalog version (0 before any bump)."""
+    state = db.session.get(CatalogState, 1)
+    return state.version if state else 0
+
+def get_catalog_state():
+    """Return (version, version of the last edit to existing books), both 0 before any bump."""
+    state = db.session.get(CatalogState, 1)
+    return (state.version, state.rebuilt_version) if state else (0, 0)
+
+def bump_catalog_version(rebuild=False):
+    """Increment the catalog version; the caller commits."""
+    return _bump(db.session, rebuild)
+
+def _bump(session, rebuild):
+    state = session.get(CatalogState, 1)
+    if state is None:
+        state = CatalogState(id=1, version=0, rebuilt_version=0)
+        session.add(state)
+    state.version += 1
+    if rebuild:
+        state.rebuilt_version = state.version
+    return state.version
+
+def _edited(book):
+    history = inspect(book).attrs
+    return any(history[name].history.has_changes() for name in SNAPSHOT_COLUMNS)
+
+@event.listens_for(Session, 'before_flush')
+def _bump_on_book_edit(session, flush_context, instances):
+    if not any(isinstance(obj, Book) for obj in session.deleted) and \
+            not any(isinstance(obj, Book) and _edited(obj) for obj in session.dirty):
+        return
+    # Skip if the code making the change already bumped for a rebuild in this flush
+    state = session.get(CatalogState, 1)
+    if state is not None and (state in session.dirty or state in session.new) \
+            and state.rebuilt_version == state.version:
+        return
+    _bump(session, rebuild=True)
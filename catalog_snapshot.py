@@ -0,0 +1,319 @@
+"""
+Read-only columnar snapshot of the catalog for the recommendation scorer.
+
+Instead of hydrating every ``Book`` (plus its lazy author and genre) on each
+request, the columns the scorer and filters read are kept as NumPy arrays,
+one entry per book, in row id order:
+
+    row_ids            int64 Book.row_id
+    ids                S36   Book.id, the external UUID
+    description_codes  int32 code into the interned description table
+    page_boost         float32 log(number_of_pages + 1) / 500, 0 without a page count
+    genre_codes        int32 code into the interned genre name table, -1 without a genre
+    subject_offsets    int64 CSR offsets into subject_codes (len(books) + 1)
+    subject_codes      int32 codes into the interned subject table
+
+Repeated strings (the "No description available" placeholder, genre names,
+subjects) are stored once in a string table and referred to by code.
+
+The snapshot is built once per process and tagged with the catalog version
+it was built from. When the version moves on, only books with a row id above
+the last one in the snapshot are loaded and appended. It is rebuilt from
+scratch instead if the version was bumped with ``rebuild=True`` (existing
+books edited or removed, which catalog.py detects on flush), if books have
+been removed, or on ``flask build-catalog-snapshot``. Every build is saved to
+``instance/catalog_snapshot.npz`` so a cold start loads it from disk instead
+of querying SQLite.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from models import db, Book, Genre
+from catalog import get_catalog_version, get_catalog_state
+
+logger = logging.getLogger('bookhunt')
+
+FORMAT_VERSION = 1
+ID_DTYPE = np.dtype('S36')
+
+
+class StringTable:
+    """Interned UTF-8 strings stored as one byte blob plus offsets."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+        self._values = None
+        self._codes = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        return self.blob[self.offsets[code]:self.offsets[code + 1]].tobytes().decode('utf-8')
+
+    def values(self):
+        """Return every string in the table, decoded once and cached."""
+        if self._values is None:
+            self._values = [self[code] for code in range(len(self))]
+        return self._values
+
+    def codes(self):
+        """Return a dict of string -> code, built on first use."""
+        if self._codes is None:
+            self._codes = {value: code for code, value in enumerate(self.values())}
+        return self._codes
+
+
+def _intern(table, values):
+    """Return (codes, table) with ``values`` interned into ``table`` (None gets code -1)."""
+    codes = dict(table.codes()) if table is not None else {}
+    strings = list(table.values()) if table is not None else []
+    result = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        if value is None:
+            result[i] = -1
+            continue
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(strings)
+            strings.append(value)
+        result[i] = code
+    if table is not None and len(strings) == len(table):
+        return result, table
+    return result, StringTable.from_strings(strings)
+
+
+class CatalogSnapshot:
+    """Columnar, read-only view of the catalog at one catalog version."""
+
+    TABLES = ('descriptions', 'genres', 'subjects')
+    ARRAYS = ('row_ids', 'ids', 'description_codes', 'page_boost', 'genre_codes', 'subject_offsets', 'subject_codes')
+
+    def __init__(self, version, arrays, tables):
+        self.version = version
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        for name in self.TABLES:
+            setattr(self, name, tables[name])
+        self._subject_owners = None
+        self._genre_partitions = None
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def description(self, i):
+        """Return the text book ``i`` is embedded from."""
+        return self.descriptions[self.description_codes[i]]
+
+    def row_ids_for(self, ids):
+        """Translate external book ids to row ids, dropping unknown ones (and anything that isn't an id)."""
+        keys = [i.encode('ascii') for i in ids if isinstance(i, str) and i.isascii()]
+        if not keys:
+            return np.empty(0, dtype=np.int64)
+        keys = np.array(keys, dtype=ID_DTYPE)
+        return self.row_ids[np.isin(self.ids, keys)]
+
+    def genre_rows(self, genre):
+        """Return the rows of the books whose genre matches ``genre`` (case-insensitive), in row id order."""
+        if self._genre_partitions is None:
+            # Group the rows by genre code once, so a filtered query only touches its partition
+            order = np.argsort(self.genre_codes, kind='stable')
+            codes, starts = np.unique(self.genre_codes[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self._genre_partitions = {int(code): order[start:end] for code, start, end in zip(codes, starts, ends)}
+        wanted = genre.strip().lower()
+        partitions = [self._genre_partitions[code] for code, name in enumerate(self.genres.values())
+                      if name.lower() == wanted and code in self._genre_partitions]
+        if not partitions:
+            return np.empty(0, dtype=np.int64)
+        return partitions[0] if len(partitions) == 1 else np.sort(np.concatenate(partitions))
+
+    def subject_matches(self, query, rows):
+        """Return, for each of ``rows``, how many of the book's subjects appear in ``query`` (case-insensitive)."""
+        query = query.lower()
+        matched = np.array([subject.lower() in query for subject in self.subjects.values()], dtype=np.float32)
+        if not matched.any():
+            return np.zeros(len(rows), dtype=np.float32)
+        if self._subject_owners is None:
+            # Each subject entry belongs to the book whose offset range contains it
+            self._subject_owners = np.repeat(np.arange(len(self)), np.diff(self.subject_offsets))
+        counts = np.bincount(self._subject_owners, weights=matched[self.subject_codes], minlength=len(self))
+        return counts[rows].astype(np.float32)
+
+    def save(self, path):
+        """Write the snapshot to ``path`` atomically."""
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        for name in self.TABLES:
+            table = getattr(self, name)
+            arrays[f'{name}_blob'] = table.blob
+            arrays[f'{name}_offsets'] = table.offsets
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, format=np.int64(FORMAT_VERSION), version=np.int64(self.version), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot written by save(); returns None if it is missing or in an old format."""
+        try:
+            with np.load(path) as data:
+                if int(data['format']) != FORMAT_VERSION:
+                    return None
+                arrays = {name: data[name] for name in cls.ARRAYS}
+                tables = {name: StringTable(data[f'{name}_blob'], data[f'{name}_offsets']) for name in cls.TABLES}
+                return cls(int(data['version']), arrays, tables)
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def _load_rows(after_row_id=0):
+    """Query the snapshot columns of books with a row id above ``after_row_id``."""
+    return (
+        db.session.query(Book.row_id, Book.id, Book.description, Book.number_of_pages, Book.subjects, Genre.name)
+        .outerjoin(Genre, Book.genre_row_id == Genre.row_id)
+        .filter(Book.row_id > after_row_id)
+        .order_by(Book.row_id)
+        .all()
+    )
+
+
+def build_snapshot(version, base=None):
+    """
+    Build a snapshot at ``version``, appending the books newer than ``base`` if given.
+
+    Returns:
+        CatalogSnapshot: The new snapshot; ``base`` is left untouched.
+    """
+    after = int(base.row_ids[-1]) if base is not None and len(base) else 0
+    rows = _load_rows(after)
+
+    row_ids = np.array([row.row_id for row in rows], dtype=np.int64)
+    ids = np.array([row.id.encode('ascii') for row in rows], dtype=ID_DTYPE)
+    # Same fallback text the embeddings are computed from (see recommendations.book_description)
+    description_codes, descriptions = _intern(
+        base.descriptions if base is not None else None,
+        [row.description if row.description else 'No description available' for row in rows])
+    pages = np.array([row.number_of_pages or 0 for row in rows], dtype=np.float64)
+    page_boost = np.where(pages > 0, np.log(pages + 1) / 500, 0).astype(np.float32)
+    genre_codes, genres = _intern(base.genres if base is not None else None, [row.name for row in rows])
+
+    subject_lists = [row.subjects or [] for row in rows]
+    subject_codes, subjects = _intern(base.subjects if base is not None else None,
+                                      [subject for subject_list in subject_lists for subject in subject_list])
+    subject_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    subject_offsets[1:] = np.cumsum([len(subject_list) for subject_list in subject_lists])
+
+    arrays = {
+        'row_ids': row_ids,
+        'ids': ids,
+        'description_codes': description_codes,
+        'page_boost': page_boost,
+        'genre_codes': genre_codes,
+        'subject_offsets': subject_offsets,
+        'subject_codes': subject_codes,
+    }
+    if base is not None:
+        subject_offsets = subject_offsets[1:] + base.subject_offsets[-1]
+        arrays = {name: np.concatenate([getattr(base, name), arrays[name]]) for name in CatalogSnapshot.ARRAYS
+                  if name != 'subject_offsets'}
+        arrays['subject_offsets'] = np.concatenate([base.subject_offsets, subject_offsets])
+    return CatalogSnapshot(version, arrays, {'descriptions': descriptions, 'genres': genres, 'subjects': subjects})
+
+
+def snapshot_path(app):
+    """Return the configured snapshot file path for ``app``."""
+    return app.config['CATALOG_SNAPSHOT_PATH'] or os.path.join(app.instance_path, 'catalog_snapshot.npz')
+
+
+# The current process's snapshot, replaced (never mutated) on refresh
+_snapshot = None
+_lock = threading.Lock()
+
+
+def refresh_snapshot(full=False):
+    """
+    Bring the process's snapshot up to the current catalog version and save it.
+
+    Args:
+        full (bool, optional): Rebuild from scratch even if an incremental
+            refresh would do, e.g. after existing books were edited.
+
+    Returns:
+        CatalogSnapshot: The current snapshot.
+    """
+    global _snapshot
+    with _lock:
+        version, rebuilt_version = get_catalog_state()
+        if _snapshot is not None and _snapshot.version == version and not full:
+            return _snapshot
+
+        start = time.perf_counter()
+        path = snapshot_path(current_app)
+        base = None
+        if not full:
+            # Cold start: the saved file is the base, and may already be current
+            base = _snapshot or CatalogSnapshot.load(path)
+            if base is not None and base.version == version:
+                _snapshot = base
+                logger.info('catalog snapshot loaded books=%d version=%d ms=%.1f',
+                            len(base), version, (time.perf_counter() - start) * 1000)
+                return base
+            # A snapshot newer than the database, from before an edit, or with books since
+            # removed can't be extended
+            if base is not None and (base.version > version or base.version < rebuilt_version
+                                     or len(base) + _count_books_after(base) != Book.query.count()):
+                base = None
+
+        snapshot = build_snapshot(version, base)
+        snapshot.save(path)
+        _snapshot = snapshot
+        logger.info('catalog snapshot %s books=%d added=%d version=%d ms=%.1f',
+                    'extended' if base is not None else 'built', len(snapshot),
+                    len(snapshot) - (len(base) if base is not None else 0), version,
+                    (time.perf_counter() - start) * 1000)
+        return snapshot
+
+
+def _count_books_after(snapshot):
+    after = int(snapshot.row_ids[-1]) if len(snapshot) else 0
+    return Book.query.filter(Book.row_id > after).count()
+
+
+def get_catalog_snapshot():
+    """Return the current snapshot, refreshing it first if the catalog version has moved on."""
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == get_catalog_version():
+        return snapshot
+    return refresh_snapshot()
+
+
+def load_books(row_ids):
+    """
+    Load the Books for ``row_ids`` (with author and genre) in one query, in the given order.
+
+    Used to hydrate only the few books a ranking returns.
+    """
+    row_ids = [int(row_id) for row_id in row_ids]
+    if not row_ids:
+        return []
+    books = {
+        book.row_id: book
+        for book in Book.query.options(joinedload(Book.author), joinedload(Book.genre))
+        .filter(Book.row_id.in_(row_ids))
+    }
+    return [books[row_id] for row_id in row_ids if row_id in books]
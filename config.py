@@ -2,3 +2,38 @@ class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///bookhunt.db'  
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = 'applesauce'
+    LOG_LEVEL = 'INFO'
+
+    # On-demand profiling: send "X-Profile: cprofile|sample|all" (or ?_profile=...)
+    PROFILING_ENABLED = False
+    PROFILE_HEADER = 'X-Profile'
+    PROFILE_QUERY_PARAM = '_profile'
+    PROFILE_TOKEN = None  # If set, the header/param value must be "<mode>:<token>"
+    PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+    PROFILE_DIR = None  # Defaults to instance/profiles
+
+    # Slow SQL log: statements slower than the threshold are logged (None disables it)
+    SLOW_QUERY_THRESHOLD_MS = 100
+    SLOW_QUERY_SAMPLE_RATE = 1.0  # Fraction of statements checked
+    SLOW_QUERY_LOG_FILE = 'slow_queries.log'  # Relative paths live in the instance folder
+
+    # Write-behind feedback: acknowledge with 202 and write to the DB in batches
+    FEEDBACK_WRITE_BEHIND = False
+    FEEDBACK_FLUSH_INTERVAL = 1.0  # Seconds between flushes
+    FEEDBACK_FLUSH_BATCH_SIZE = 100  # Flush early once this many books are pending
+    FEEDBACK_JOURNAL_DIR = None  # Defaults to instance/feedback_journal
+    FEEDBACK_JOURNAL_FSYNC = True
+
+    # Production entry point (wsgi.py): load the model and warm the catalog before forking
+    PRELOAD_CATALOG = True
+
+    # Memory-mapped book embedding file built by "flask build-embeddings"
+    EMBEDDING_STORE_PATH = None  # Defaults to instance/embeddings.bhe
+
+    # Columnar catalog snapshot the recommendation scorer runs against
+    CATALOG_SNAPSHOT_PATH = None  # Defaults to instance/catalog_snapshot.npz
+
+    # Server-side ranked result cursors for /api/recommendations/next
+    RANKING_CURSOR_DEPTH = 100  # Books kept per ranking
+    RANKING_CURSOR_TTL = 900  # Seconds before a ranking is recomputed
+    RANKING_CURSOR_DIR = None  # Defaults to instance/ranking_cursors
@@ -0,0 +1,190 @@
+"""
+On-disk book embedding matrix, memory-mapped and shared across processes.
+
+File layout (little-endian), built by ``flask build-embeddings``:
+
+    header    magic, format version, dim, row count, dtype, model id length,
+              and the byte offsets of the blocks below
+    model id  UTF-8 name of the model that produced the vectors
+    vectors   rows x dim matrix (float32 or float16), 64-byte aligned
+    norms     rows float32 L2 norms of the vectors
+    row ids   rows int64 book row ids (Book.row_id), sorted, so row i belongs
+              to book row_ids[i]
+
+Every block is opened with ``np.memmap``, so all workers read the same page
+cache with no per-process copy and opening a store is near-instant. A rebuilt
+file is written next to the live one and renamed over it; readers notice the
+new inode on their next lookup and switch to it without a restart, while
+requests already holding the old mapping keep using it safely.
+"""
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+from flask import current_app, has_app_context
+
+logger = logging.getLogger('bookhunt')
+
+MAGIC = b'BHEMBED\0'
+FORMAT_VERSION = 2
+# magic, version, dim, rows, dtype code, model id length, vectors/norms/row ids offsets
+HEADER = struct.Struct('<8sIIQBxxxIQQQ')
+DTYPES = {0: np.float32, 1: np.float16}
+DTYPE_CODES = {np.dtype(dtype): code for code, dtype in DTYPES.items()}
+ALIGNMENT = 64
+ROW_ID_DTYPE = np.dtype('<i8')
+
+# How often readers check whether the file has been swapped (seconds)
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class EmbeddingStore:
+    """A read-only, memory-mapped view of an embedding file."""
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.file_key = (stat.st_ino, stat.st_mtime_ns)
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            (magic, version, self.dim, self.rows, dtype_code, model_id_len,
+             vectors_offset, norms_offset, row_ids_offset) = HEADER.unpack(header)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f'{path} is not a version {FORMAT_VERSION} embedding file')
+            self.model_id = f.read(model_id_len).decode('utf-8')
+
+        self.dtype = np.dtype(DTYPES[dtype_code])
+        if self.rows:
+            self.vectors = np.memmap(path, dtype=self.dtype, mode='r', offset=vectors_offset, shape=(self.rows, self.dim))
+            self.norms = np.memmap(path, dtype=np.float32, mode='r', offset=norms_offset, shape=(self.rows,))
+            self.row_ids = np.memmap(path, dtype=ROW_ID_DTYPE, mode='r', offset=row_ids_offset, shape=(self.rows,))
+        else:
+            self.vectors = np.empty((0, self.dim), dtype=self.dtype)
+            self.norms = np.empty(0, dtype=np.float32)
+            self.row_ids = np.empty(0, dtype=ROW_ID_DTYPE)
+
+    def __len__(self):
+        return self.rows
+
+    def rows_for(self, book_row_ids):
+        """
+        Look up the matrix rows for a list of book row ids.
+
+        Returns:
+            np.ndarray: Matrix row per book, -1 where the book isn't in the store.
+        """
+        keys = np.asarray(book_row_ids, dtype=ROW_ID_DTYPE)
+        if not self.rows:
+            return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.row_ids, keys), self.rows - 1)
+        return np.where(self.row_ids[rows] == keys, rows, -1)
+
+    def get(self, book_row_id):
+        """Return the embedding vector for a book row id (a read-only view), or None."""
+        row = self.rows_for([book_row_id])[0]
+        return self.vectors[row] if row >= 0 else None
+
+
+def write_embedding_store(path, model_id, book_row_ids, vectors, dtype=np.float32):
+    """
+    Write an embedding file and atomically swap it in at ``path``.
+
+    Args:
+        path (str): Destination path.
+        model_id (str): Name of the model that produced the vectors.
+        book_row_ids (list): Book row id per row of ``vectors``.
+        vectors (np.ndarray): rows x dim embedding matrix.
+        dtype: np.float32 or np.float16.
+    """
+    vectors = np.asarray(vectors, dtype=dtype)
+    if vectors.ndim != 2 or len(vectors) != len(book_row_ids):
+        raise ValueError('vectors must be a 2-D array with one row per book')
+
+    # Rows are stored sorted by row id so lookups are a binary search on the mapped id table
+    row_ids = np.asarray(book_row_ids, dtype=ROW_ID_DTYPE)
+    order = np.argsort(row_ids, kind='stable')
+    row_ids, vectors = row_ids[order], vectors[order]
+    norms = np.linalg.norm(vectors.astype(np.float32), axis=1).astype(np.float32)
+
+    rows, dim = vectors.shape
+    model_bytes = model_id.encode('utf-8')
+    vectors_offset = _align(HEADER.size + len(model_bytes))
+    norms_offset = _align(vectors_offset + vectors.nbytes)
+    row_ids_offset = _align(norms_offset + norms.nbytes)
+
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, dim, rows, DTYPE_CODES[vectors.dtype],
+                            len(model_bytes), vectors_offset, norms_offset, row_ids_offset))
+        f.write(model_bytes)
+        for offset, block in ((vectors_offset, vectors), (norms_offset, norms), (row_ids_offset, row_ids)):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(np.ascontiguousarray(block).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Make this process pick the new file up immediately
+    _open_stores.pop(path, None)
+    logger.info('embedding store written path=%s rows=%d dim=%d dtype=%s', path, rows, dim, vectors.dtype)
+
+
+# Per-process cache of the open store: path -> (store, time of last stat check)
+_open_stores = {}
+
+
+def open_embedding_store(path):
+    """
+    Return the store at ``path``, reopening it if the file has been swapped.
+
+    Returns:
+        EmbeddingStore or None: None if the file doesn't exist.
+    """
+    store, checked_at = _open_stores.get(path, (None, 0.0))
+    now = time.monotonic()
+    if store is not None and now - checked_at < RELOAD_CHECK_INTERVAL:
+        return store
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _open_stores.pop(path, None)
+        return None
+    if store is None or store.file_key != (stat.st_ino, stat.st_mtime_ns):
+        try:
+            store = EmbeddingStore(path)
+        except ValueError:
+            logger.warning('embedding store ignored path=%s reason=unsupported format; rebuild it', path)
+            _open_stores.pop(path, None)
+            return None
+        logger.info('embedding store opened path=%s rows=%d model=%s', path, store.rows, store.model_id)
+    _open_stores[path] = (store, now)
+    return store
+
+
+def embedding_store_path(app):
+    """Return the configured embedding file path for ``app``."""
+    return app.config['EMBEDDING_STORE_PATH'] or os.path.join(app.instance_path, 'embeddings.bhe')
+
+
+def get_embedding_store(model_id):
+    """
+    Return the current app's embedding store if it was built with ``model_id``.
+
+    Returns:
+        EmbeddingStore or None: None outside an app context, if the file is
+        missing, or if it was built with a different model.
+    """
+    if not has_app_context():
+        return None
+    store = open_embedding_store(embedding_store_path(current_app))
+    if store is None or store.model_id != model_id:
+        return None
+    return store
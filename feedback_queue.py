@@ -0,0 +1,315 @@
+"""
+Optional write-behind queue for feedback writes.
+
+With ``FEEDBACK_WRITE_BEHIND`` enabled, feedback is appended to a local
+journal (fsynced) and acknowledged straight away. Events are coalesced per
+book and written to the database in one transaction every
+``FEEDBACK_FLUSH_INTERVAL`` seconds, or sooner once
+``FEEDBACK_FLUSH_BATCH_SIZE`` books are pending.
+
+The journal is rotated to ``<name>.flushing`` before a batch is written and
+removed after the commit, so a crash at any point is recovered by replaying
+whatever journal files are left on the next start. Replaying is idempotent:
+feedback sets a state, it doesn't toggle one.
+
+Each process takes its own journal slot, guarded by an exclusive file lock
+where the platform has one, so several workers can share the journal
+directory and a slot left behind by a crashed worker is replayed by the next
+worker that claims it. Every event carries the time it was given: the
+not-yet-written feedback a request sees is read from every slot's journal,
+newest event per book, and a flush never overwrites feedback given later
+than the event it writes, whichever worker flushes first.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+
+from models import db, Book, UserBooks
+from catalog_snapshot import get_catalog_snapshot
+from recommendations import apply_feedback_batch, chunked
+
+try:
+    import fcntl
+except ImportError:  # Windows: single process, no locking
+    fcntl = None
+
+logger = logging.getLogger('bookhunt')
+
+
+class FeedbackQueue:
+    """Journaled, coalescing write-behind buffer for feedback events."""
+
+    def __init__(self, app, journal_dir, flush_interval, batch_size, fsync=True):
+        self.app = app
+        self.journal_dir = journal_dir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+
+        self._lock = threading.Lock()  # Guards _pending, _inflight and the journal handle
+        self._flush_lock = threading.Lock()  # Only one flush at a time
+        self._wake = threading.Event()
+        self._pending = {}  # book_id -> (feedback, status, ts), not yet being written
+        self._inflight = {}  # book_id -> (feedback, status, ts), in the batch being written
+        self._pid = None
+        self._journal = None
+        self._journal_path = None
+        self._flushing_path = None
+        self._lock_file = None
+
+    def submit(self, book_id, feedback, status='pending'):
+        """
+        Journal a feedback event and queue it for the next flush.
+
+        The caller validates the event first (see known_book_ids): once
+        journaled it is replayed on every start until it has been written.
+        """
+        self.submit_many([(book_id, feedback, status)])
+
+    def submit_many(self, events):
+        """
+        Journal many feedback events with a single fsync and queue them for the next flush.
+
+        Args:
+            events (list): (book_id, feedback, status) tuples, applied in order.
+        """
+        if not all(isinstance(value, str) for event in events for value in event):
+            raise TypeError('book_id, feedback and status must be strings')
+        if not events:
+            return
+        self._ensure_started()
+        with self._lock:
+            # Timestamped under the lock so events are journaled in time order
+            now = time.time()
+            self._journal.write(''.join(
+                json.dumps({'book_id': book_id, 'feedback': feedback, 'status': status, 'ts': now}) + '\n'
+                for book_id, feedback, status in events
+            ))
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            for book_id, feedback, status in events:
+                self._pending[book_id] = (feedback, status, now)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def pending_feedback(self):
+        """
+        Return feedback that has been accepted but not yet committed, by any worker.
+
+        Reads every slot's journal files, which only hold the events since
+        their worker's last flush.
+
+        Returns:
+            dict: book_id -> feedback, newest event per book.
+        """
+        self._ensure_started()
+        events = {}
+        for name in os.listdir(self.journal_dir):
+            if not name.endswith('.lock'):
+                continue
+            base = os.path.join(self.journal_dir, name[:-len('.lock')])
+            for path in (base + '.jsonl', base + '.flushing'):
+                for event in _read_events(path)[0]:
+                    _merge_newest(events, event)
+        return {book_id: feedback for book_id, (feedback, _, _) in events.items()}
+
+    def flush(self):
+        """
+        Write all queued feedback to the database in a single transaction.
+
+        Returns:
+            int: Number of books written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                # A previous failed flush leaves its batch in flight; retry it first
+                if not self._inflight:
+                    if not self._pending:
+                        return 0
+                    self._inflight, self._pending = self._pending, {}
+                    self._rotate_journal()
+                batch = dict(self._inflight)
+
+            with self.app.app_context():
+                try:
+                    apply_feedback_batch([(book_id, feedback, status) for book_id, (feedback, status, _) in batch.items()],
+                                         [ts for feedback, status, ts in batch.values()])
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('feedback flush failed books=%d', len(batch))
+                    return 0
+
+            with self._lock:
+                self._inflight = {}
+            os.remove(self._flushing_path)
+            logger.debug('feedback flushed books=%d', len(batch))
+            return len(batch)
+
+    def close(self):
+        """Flush whatever is queued; called at interpreter exit."""
+        if self._pid == os.getpid():
+            self.flush()
+
+    def _ensure_started(self):
+        # Threads and file locks don't survive a fork, so (re)start lazily in each process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pending, self._inflight = {}, {}
+            self._claim_slot()
+            self._recover()
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='bookhunt-feedback-flush', daemon=True).start()
+        atexit.register(self.close)
+        if self._inflight:
+            self._wake.set()
+
+    def _claim_slot(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        slot = 0
+        while True:
+            base = os.path.join(self.journal_dir, f'feedback-{slot}')
+            lock_file = open(base + '.lock', 'w')
+            if fcntl is None:
+                break
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                lock_file.close()
+                slot += 1
+        self._lock_file = lock_file
+        self._journal_path = base + '.jsonl'
+        self._flushing_path = base + '.flushing'
+
+    def _recover(self):
+        # Merge leftovers from a crashed predecessor (oldest first) into one in-flight batch
+        recovered = {}
+        for path in (self._flushing_path, self._journal_path):
+            events, malformed = _read_events(path)
+            for event in events:
+                _merge_newest(recovered, event)
+            if malformed:
+                logger.warning('feedback journal skipped malformed events count=%d path=%s', malformed, path)
+        if recovered:
+            self._write_batch(self._flushing_path, recovered)
+            logger.info('feedback journal recovered books=%d path=%s', len(recovered), self._journal_path)
+        elif os.path.exists(self._flushing_path):
+            os.remove(self._flushing_path)
+        self._inflight = recovered
+        self._journal = open(self._journal_path, 'w')
+
+    def _write_batch(self, path, batch):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for book_id, (feedback, status, ts) in batch.items():
+                f.write(json.dumps({'book_id': book_id, 'feedback': feedback, 'status': status, 'ts': ts}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _rotate_journal(self):
+        # Called with _lock held: the current journal becomes the in-flight batch's record
+        self._journal.close()
+        os.replace(self._journal_path, self._flushing_path)
+        self._journal = open(self._journal_path, 'w')
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('feedback flush thread error')
+
+
+def _valid_event(event):
+    return (isinstance(event, dict)
+            and isinstance(event.get('book_id'), str)
+            and isinstance(event.get('feedback'), str)
+            and isinstance(event.get('status', 'pending'), str)
+            and isinstance(event.get('ts', 0), (int, float)))
+
+
+def _read_events(path):
+    """Return (valid events, number of malformed ones) from journal file ``path``; a missing file has none."""
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except OSError:
+        return [], 0
+    events = []
+    malformed = 0
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue  # Torn last line from a crash mid-write, or one still being written
+        if _valid_event(event):
+            events.append(event)
+        else:
+            malformed += 1
+    return events, malformed
+
+
+def _merge_newest(merged, event):
+    # Keep the newest event per book; events from before timestamps count as oldest
+    ts = event.get('ts', 0)
+    current = merged.get(event['book_id'])
+    if current is None or ts >= current[2]:
+        merged[event['book_id']] = (event['feedback'], event.get('status', 'pending'), ts)
+
+
+def init_feedback_queue(app):
+    """Set up the write-behind queue on ``app`` if FEEDBACK_WRITE_BEHIND is enabled."""
+    if not app.config['FEEDBACK_WRITE_BEHIND']:
+        return None
+    journal_dir = app.config['FEEDBACK_JOURNAL_DIR'] or os.path.join(app.instance_path, 'feedback_journal')
+    queue = FeedbackQueue(
+        app,
+        journal_dir,
+        app.config['FEEDBACK_FLUSH_INTERVAL'],
+        app.config['FEEDBACK_FLUSH_BATCH_SIZE'],
+        app.config['FEEDBACK_JOURNAL_FSYNC'],
+    )
+    app.extensions['feedback_queue'] = queue
+    return queue
+
+
+def get_feedback_queue():
+    """Return the current app's write-behind queue, or None if it is disabled."""
+    return current_app.extensions.get('feedback_queue')
+
+
+def pending_rejections():
+    """Return the ids of books rejected but not yet written to the database."""
+    queue = get_feedback_queue()
+    if queue is None:
+        return set()
+    return {book_id for book_id, feedback in queue.pending_feedback().items() if feedback == 'reject'}
+
+
+def rejected_row_ids():
+    """Return the row ids of every rejected book, including rejections still in the write-behind queue."""
+    rejected = {row_id for (row_id,) in db.session.query(UserBooks.book_row_id).filter_by(feedback='reject')}
+    rejected.update(get_catalog_snapshot().row_ids_for(pending_rejections()).tolist())
+    return rejected
+
+
+def known_book_ids(book_ids):
+    """Return which of ``book_ids`` belong to a book in the catalog, checked before feedback is queued."""
+    known = set()
+    for chunk in chunked(list(set(book_ids))):
+        known.update(book_id for book_id, in db.session.query(Book.id).filter(Book.id.in_(chunk)))
+    return known
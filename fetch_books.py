@@ -1,8 +1,13 @@
 import os
 import requests
 from dotenv import load_dotenv
-from models import db, Book, Author, Genre
+from models import db, Book, Author
 from app import app
+from catalog import bump_catalog_version
+from embedding_store import embedding_store_path, open_embedding_store
+from neighbors import update_neighbors
+from recommendations import build_embedding_store, chunked
+from genres import classify_books
 
 # Load environment variables from .env
 load_dotenv()
@@ -52,11 +57,18 @@ def fetch_books_from_google_books(query="fiction", max_results=1000, batch_size=
 
 def save_books_to_db(books):
     """
-    Saves a list of books to the database, including author, genre, and metadata.
+    Saves a list of books to the database, including author and metadata.
+
+    The Google Books categories are kept in ``subjects``; genres are assigned
+    afterwards in one batch by classify_new_books.
 
     Args:
         books (list): A list of book dictionaries retrieved from the Google Books API.
+
+    Returns:
+        list: The row ids of the books that were added.
     """
+    new_books = []
     with app.app_context():
         for book in books:
             volume_info = book.get("volumeInfo", {})
@@ -66,9 +78,10 @@ def save_books_to_db(books):
             published_year = (
                 volume_info.get("publishedDate", "").split("-")[0] if "publishedDate" in volume_info else None
             )
+            categories = volume_info.get("categories", [])
 
             # Handle authors
-            author_id = None
+            author_row_id = None
             if authors:
                 for author_name in authors:
                     author = Author.query.filter_by(name=author_name).first()
@@ -76,14 +89,7 @@ def save_books_to_db(books):
                         author = Author(name=author_name)
                         db.session.add(author)
                         db.session.commit()
-                    author_id = author.id
-
-            # Handle genre (default to "Unknown")
-            genre = Genre.query.filter_by(name="Unknown").first()
-            if not genre:
-                genre = Genre(name="Unknown")
-                db.session.add(genre)
-                db.session.commit()
+                    author_row_id = author.row_id
 
             # Add book to database
             if title:
@@ -93,13 +99,61 @@ def save_books_to_db(books):
                         title=title,
                         description=description,
                         published_year=published_year,
-                        author_id=author_id,
-                        genre_id=genre.id,
+                        author_row_id=author_row_id,
+                        subjects=categories,
                     )
                     db.session.add(new_book)
+                    new_books.append(new_book)
 
+        if new_books:
+            bump_catalog_version()
         db.session.commit()
         print(f"{len(books)} books saved to the database.")
+        return [book.row_id for book in new_books]
+
+
+def update_indexes(book_row_ids):
+    """
+    Brings the embedding file and the similar-books lists up to date after a sync.
+
+    Only the new books are encoded, and only the neighbour lists they can
+    affect are recomputed.
+
+    Args:
+        book_row_ids (list): The row ids of the books added by the sync.
+    """
+    with app.app_context():
+        path = embedding_store_path(app)
+        if open_embedding_store(path) is None:
+            print("No embedding file yet; run 'flask build-embeddings' and 'flask build-neighbors'.")
+            return
+        build_embedding_store(path, Book.query.all(), incremental=True)
+        count = update_neighbors(open_embedding_store(path), book_row_ids)
+        print(f"Encoded {len(book_row_ids)} new books and refreshed neighbours for {count} books.")
+
+
+def classify_new_books(book_row_ids):
+    """
+    Assigns genres to the books added by the sync in one batch.
+
+    Runs after update_indexes, so the books' description embeddings are read
+    from the embedding file instead of being encoded a second time.
+
+    Args:
+        book_row_ids (list): The row ids of the books added by the sync.
+    """
+    with app.app_context():
+        books = []
+        for chunk in chunked(book_row_ids):
+            books.extend(Book.query.filter(Book.row_id.in_(chunk)))
+        counts = classify_books(books)
+        # Existing rows changed, so catalog snapshots are rebuilt rather than extended
+        bump_catalog_version(rebuild=True)
+        db.session.commit()
+        print(
+            f"Classified {len(books)} new books: {counts['categories']} from categories, "
+            f"{counts['embedding']} by description, {counts['unknown']} unknown."
+        )
 
 
 if __name__ == "__main__":
@@ -108,6 +162,9 @@ if __name__ == "__main__":
     books = fetch_books_from_google_books(query="fiction", max_results=1000, batch_size=40)
     if books:
         print(f"Fetched {len(books)} books. Saving to database...")
-        save_books_to_db(books)
+        new_book_row_ids = save_books_to_db(books)
+        if new_book_row_ids:
+            update_indexes(new_book_row_ids)
+            classify_new_books(new_book_row_ids)
     else:
         print("No books found or failed to fetch books.")
\ No newline at end of file
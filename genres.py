@@ -0,0 +1,251 @@
+"""
+Batch genre classification for ingest and backfill.
+
+Each book is assigned a genre in two passes:
+
+1. Rules over its Google Books categories (stored in ``Book.subjects``), e.g.
+   "Fiction / Science Fiction / General" -> Science Fiction. Rules match
+   whole terms of the category path, never substrings, and non-fiction
+   subjects are checked first: "Literary Criticism" is not Literary Fiction,
+   "Political Science" is not Science and "True Crime" is not Mystery.
+2. Books no rule matches are assigned the genre whose prototype text is
+   nearest to their description embedding. The vectors come from the
+   embedding file where the book has one and are encoded in batches
+   otherwise, and the prototypes are scored with one matrix multiply per
+   batch.
+
+Books with neither categories nor a description get "Unknown".
+"""
+import logging
+import re
+
+import numpy as np
+
+from models import db, Book, Genre
+from catalog import bump_catalog_version
+from embedding_store import get_embedding_store
+from recommendations import MODEL_NAME, encode_texts
+
+logger = logging.getLogger('bookhunt')
+
+UNKNOWN_GENRE = 'Unknown'
+
+# What ingest stores when Google Books has no description; it says nothing about the genre
+PLACEHOLDER_DESCRIPTION = 'No description available.'
+
+# Genre name -> text its prototype embedding is computed from
+GENRE_PROTOTYPES = {
+    'Fantasy': 'A fantasy novel of magic, wizards, dragons, quests and imaginary kingdoms.',
+    'Science Fiction': 'A science fiction novel about space travel, the future, aliens, robots and advanced technology.',
+    'Mystery': 'A mystery novel in which a detective investigates a murder and uncovers clues to solve the crime.',
+    'Thriller': 'A suspense thriller full of danger, conspiracy, spies, chases and a race against time.',
+    'Romance': 'A romance novel about two people falling in love, relationships and passion.',
+    'Horror': 'A horror novel of ghosts, monsters, haunted houses, terror and the supernatural.',
+    'Historical Fiction': 'A historical novel set in a past era, during a war or in a royal court long ago.',
+    'Literary Fiction': 'A literary novel exploring family, identity, memory and the inner lives of its characters.',
+    'Young Adult': 'A young adult novel about a teenager coming of age, high school, friendship and first love.',
+    "Children's": "A children's book for young readers with animals, adventure and a gentle lesson.",
+    'Biography': 'A biography or memoir telling the true story of a real person\'s life.',
+    'History': 'A nonfiction history book about historical events, empires, wars and civilizations.',
+    'Science': 'A popular science book explaining physics, biology, nature, the universe and discoveries.',
+    'Self-Help': 'A self-help book with advice on habits, productivity, happiness and personal growth.',
+    'Business': 'A business book about companies, leadership, management, economics and money.',
+    'Philosophy & Religion': 'A book on philosophy, religion, faith, ethics and the meaning of life.',
+    'Poetry': 'A collection of poems and verse.',
+    'Comics': 'A graphic novel or comic book told in illustrated panels.',
+    'True Crime': 'A true crime book recounting real murders, criminals, investigations and trials.',
+    'Social Science': 'A nonfiction book about society, politics, government, psychology and culture.',
+    'Essays & Criticism': 'A collection of essays, letters or literary criticism about writers and their works.',
+}
+
+# (term of a category path, genre), checked in this order whichever segment the term
+# is in. Non-fiction for children comes first, then the other non-fiction subjects,
+# so e.g. "True Crime / Murder" never reaches the fiction rules, then the fiction
+# genres before the audience-only ones.
+CATEGORY_RULES = [
+    ('juvenile nonfiction', "Children's"),
+    ('young adult nonfiction', 'Young Adult'),
+    ('true crime', 'True Crime'),
+    ('literary criticism', 'Essays & Criticism'),
+    ('literary collections', 'Essays & Criticism'),
+    ('social science', 'Social Science'),
+    ('political science', 'Social Science'),
+    ('psychology', 'Social Science'),
+    ('biography', 'Biography'),
+    ('autobiography', 'Biography'),
+    ('history', 'History'),
+    ('self-help', 'Self-Help'),
+    ('business', 'Business'),
+    ('economics', 'Business'),
+    ('philosophy', 'Philosophy & Religion'),
+    ('religion', 'Philosophy & Religion'),
+    ('poetry', 'Poetry'),
+    ('comics', 'Comics'),
+    ('graphic novels', 'Comics'),
+    ('science', 'Science'),
+    ('nature', 'Science'),
+    ('science fiction', 'Science Fiction'),
+    ('fantasy', 'Fantasy'),
+    ('mystery', 'Mystery'),
+    ('detective', 'Mystery'),
+    ('crime', 'Mystery'),
+    ('thrillers', 'Thriller'),
+    ('thriller', 'Thriller'),
+    ('suspense', 'Thriller'),
+    ('romance', 'Romance'),
+    ('horror', 'Horror'),
+    ('ghost', 'Horror'),
+    ('historical', 'Historical Fiction'),
+    ('literary', 'Literary Fiction'),
+    ('young adult fiction', 'Young Adult'),
+    ('juvenile fiction', "Children's"),
+]
+
+# Term -> (rule priority, genre)
+_RULES = {term: (priority, genre) for priority, (term, genre) in enumerate(CATEGORY_RULES)}
+
+# Prototype matrix per model, unit-length rows in GENRE_PROTOTYPES order
+_prototypes = {}
+
+
+def genre_from_categories(categories, cache=None):
+    """
+    Return the genre the first matching category maps to, or None.
+
+    Args:
+        categories (list): Google Books categories / subjects of a book.
+        cache (dict, optional): category -> genre results to reuse across a batch.
+    """
+    for category in categories or []:
+        if cache is not None and category in cache:
+            genre = cache[category]
+        else:
+            genre = _genre_for_category(category)
+            if cache is not None:
+                cache[category] = genre
+        if genre:
+            return genre
+    return None
+
+
+def _category_terms(category):
+    """Split a category path into lowercased terms: "Fiction / Mystery & Detective" -> fiction, mystery, detective."""
+    return [term.strip().lower() for term in re.split(r'[/&,]', category) if term.strip()]
+
+
+def _genre_for_category(category):
+    matches = [_RULES[term] for term in _category_terms(category) if term in _RULES]
+    return min(matches)[1] if matches else None
+
+
+def _unit_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, None]
+
+
+def genre_prototypes():
+    """Return the unit-length prototype embedding per genre, encoded once per process."""
+    if MODEL_NAME not in _prototypes:
+        _prototypes[MODEL_NAME] = _unit_rows(encode_texts(list(GENRE_PROTOTYPES.values()), kind='genre'))
+    return _prototypes[MODEL_NAME]
+
+
+def nearest_genres(vectors, prototypes=None):
+    """Return the name of the nearest genre prototype for each row of ``vectors``."""
+    prototypes = genre_prototypes() if prototypes is None else prototypes
+    names = list(GENRE_PROTOTYPES)
+    best = np.argmax(_unit_rows(vectors) @ prototypes.T, axis=1)
+    return [names[i] for i in best]
+
+
+def _description_vectors(books):
+    """Return a len(books) x dim matrix of description embeddings, from the embedding file where possible."""
+    vectors = [None] * len(books)
+    store = get_embedding_store(MODEL_NAME)
+    if store is not None:
+        rows = store.rows_for([book.row_id for book in books])
+        for i in np.flatnonzero(rows >= 0):
+            vectors[i] = np.asarray(store.vectors[rows[i]], dtype=np.float32)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        for i, vector in zip(missing, encode_texts([books[i].description for i in missing])):
+            vectors[i] = vector
+    return np.stack(vectors)
+
+
+def get_or_create_genres(names):
+    """Return a dict of genre name -> Genre for ``names``, creating missing genres (the caller commits)."""
+    genres = {genre.name: genre for genre in Genre.query.filter(Genre.name.in_(list(names)))}
+    for name in names:
+        if name not in genres:
+            genres[name] = Genre(name=name)
+            db.session.add(genres[name])
+    db.session.flush()  # Assigns row ids
+    return genres
+
+
+def classify_books(books, batch_size=64):
+    """
+    Assign a genre to each of ``books`` (the caller commits).
+
+    Args:
+        books (list): Books to classify; their genre is overwritten.
+        batch_size (int, optional): Books embedded and scored per batch.
+
+    Returns:
+        dict: Number of books classified per source ('categories', 'embedding', 'unknown').
+    """
+    category_cache = {}
+    assigned = {}
+    to_embed = []
+    counts = {'categories': 0, 'embedding': 0, 'unknown': 0}
+    for book in books:
+        genre = genre_from_categories(book.subjects, category_cache)
+        if genre:
+            assigned[book.row_id] = genre
+            counts['categories'] += 1
+        elif book.description and book.description != PLACEHOLDER_DESCRIPTION:
+            to_embed.append(book)
+            counts['embedding'] += 1
+        else:
+            assigned[book.row_id] = UNKNOWN_GENRE
+            counts['unknown'] += 1
+
+    for start in range(0, len(to_embed), batch_size):
+        batch = to_embed[start:start + batch_size]
+        for book, genre in zip(batch, nearest_genres(_description_vectors(batch))):
+            assigned[book.row_id] = genre
+
+    genres = get_or_create_genres(set(assigned.values()))
+    for book in books:
+        book.genre_row_id = genres[assigned[book.row_id]].row_id
+    logger.info('genres classified books=%d categories=%d embedding=%d unknown=%d',
+                len(books), counts['categories'], counts['embedding'], counts['unknown'])
+    return counts
+
+
+def backfill_genres(reclassify_all=False, batch_size=64):
+    """
+    Classify the books without a genre (or with "Unknown"), or every book.
+
+    Commits once at the end and bumps the catalog version so snapshots are
+    rebuilt with the new genres.
+
+    Returns:
+        dict: As classify_books.
+    """
+    query = Book.query
+    if not reclassify_all:
+        unknown = Genre.query.filter_by(name=UNKNOWN_GENRE).first()
+        condition = Book.genre_row_id.is_(None)
+        if unknown is not None:
+            condition = condition | (Book.genre_row_id == unknown.row_id)
+        query = query.filter(condition)
+    books = query.order_by(Book.row_id).all()
+    counts = classify_books(books, batch_size)
+    if books:
+        bump_catalog_version(rebuild=True)
+    db.session.commit()
+    return counts
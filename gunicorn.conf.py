@@ -0,0 +1,35 @@
+"""
+Gunicorn configuration for BookHunt.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Settings can be overridden with environment variables:
+
+    BOOKHUNT_BIND           address to listen on (default 127.0.0.1:8000)
+    BOOKHUNT_WORKERS        number of worker processes (default 2)
+    BOOKHUNT_TORCH_THREADS  intra-op threads per worker (default: cores / workers)
+    BOOKHUNT_PRELOAD        set to 0 to load the app in every worker instead of
+                            once in the master (useful for measure_memory.py)
+"""
+import os
+
+bind = os.environ.get('BOOKHUNT_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('BOOKHUNT_WORKERS', '2'))
+worker_class = 'sync'
+
+# Load the model and catalog in the master so workers share them copy-on-write
+preload_app = os.environ.get('BOOKHUNT_PRELOAD', '1') != '0'
+
+# Encoding a query on CPU can take a while; don't let the arbiter kill slow requests
+timeout = 120
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    # Give each worker an equal share of the cores so N workers x M torch threads
+    # doesn't oversubscribe the machine
+    import torch
+
+    threads = int(os.environ.get('BOOKHUNT_TORCH_THREADS', '0')) or max(1, (os.cpu_count() or 1) // server.cfg.workers)
+    torch.set_num_threads(threads)
+    server.log.info('worker %s using %d torch threads', worker.pid, threads)
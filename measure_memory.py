@@ -0,0 +1,104 @@
+"""
+Report per-process memory for a gunicorn master and its workers.
+
+Reads /proc/<pid>/smaps_rollup (Linux) and prints RSS, PSS and USS for every
+process. USS (private pages) is what each extra worker really costs; PSS
+splits shared pages fairly between the processes sharing them.
+
+Usage:
+    python measure_memory.py <master_pid> [--json report.json]
+    python measure_memory.py <master_pid> --compare before.json
+
+Typical before/after run:
+    BOOKHUNT_PRELOAD=0 gunicorn -c gunicorn.conf.py wsgi:app &
+    python measure_memory.py <pid> --json before.json
+    gunicorn -c gunicorn.conf.py wsgi:app &
+    python measure_memory.py <pid> --compare before.json
+"""
+import argparse
+import json
+import os
+
+
+def read_smaps_rollup(pid):
+    """Return RSS, PSS and USS in KiB for ``pid``."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":"):
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "uss": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
+
+
+def child_pids(pid):
+    """Return the pids of the direct children of ``pid``."""
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; the ppid follows the closing paren
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def measure(master_pid):
+    """Measure the master and each of its workers."""
+    report = {"master": read_smaps_rollup(master_pid), "workers": {}}
+    for pid in child_pids(master_pid):
+        report["workers"][str(pid)] = read_smaps_rollup(pid)
+    workers = list(report["workers"].values())
+    report["totals"] = {
+        key: report["master"][key] + sum(worker[key] for worker in workers) for key in ("rss", "pss", "uss")
+    }
+    report["mean_worker_uss"] = sum(w["uss"] for w in workers) / len(workers) if workers else 0
+    return report
+
+
+def mib(kib):
+    return f"{kib / 1024:9.1f}"
+
+
+def print_report(report):
+    print(f"{'process':>16} {'RSS MiB':>9} {'PSS MiB':>9} {'USS MiB':>9}")
+    master = report["master"]
+    print(f"{'master':>16} {mib(master['rss'])} {mib(master['pss'])} {mib(master['uss'])}")
+    for pid, worker in report["workers"].items():
+        print(f"{'worker ' + pid:>16} {mib(worker['rss'])} {mib(worker['pss'])} {mib(worker['uss'])}")
+    totals = report["totals"]
+    print(f"{'total':>16} {mib(totals['rss'])} {mib(totals['pss'])} {mib(totals['uss'])}")
+    print(f"Mean worker USS: {mib(report['mean_worker_uss']).strip()} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("master_pid", type=int, help="pid of the gunicorn master")
+    parser.add_argument("--json", help="save the report to this file")
+    parser.add_argument("--compare", help="compare against a report saved with --json")
+    args = parser.parse_args()
+
+    report = measure(args.master_pid)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+        print()
+        print("Change vs", args.compare)
+        for key in ("rss", "pss", "uss"):
+            print(f"  total {key.upper()}: {mib(before['totals'][key]).strip()} -> {mib(report['totals'][key]).strip()} MiB")
+        print(f"  mean worker USS: {mib(before['mean_worker_uss']).strip()} -> {mib(report['mean_worker_uss']).strip()} MiB")
@@ -0,0 +1,261 @@
+"""
+Request instrumentation for the hot paths.
+
+Every request gets a small timing breakdown (DB time and query count, model
+load, query encoding, scoring, serialization) which is returned as a
+``Server-Timing`` header. The same numbers are aggregated process-wide into
+histograms and counters and exposed in Prometheus text format on ``/metrics``.
+
+The registry is per process, so every exposed sample carries a ``pid``
+label telling gunicorn workers apart.
+
+Phases are exclusive: time spent in a nested phase (e.g. ``model_load``
+inside ``encode_query``) or in SQL statements is charged to that phase or to
+``db`` only, never also to the enclosing one, so the phases of a request add
+up to at most its total.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('bookhunt')
+
+# Latency buckets in seconds, roughly log-spaced from 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for "number of SQL statements per request"
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 500)
+
+_lock = threading.Lock()
+
+# Per-thread stack of the phases currently open: [phase, start, seconds spent in children]
+_phases = threading.local()
+
+
+class Counter:
+    """A monotonically increasing counter with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self, constant_labels=()):
+        names = tuple(name for name, _ in constant_labels) + self.labelnames
+        constant = tuple(value for _, value in constant_labels)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(names, constant + key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """A cumulative histogram with fixed buckets and optional labels."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def expose(self, constant_labels=()):
+        names = tuple(name for name, _ in constant_labels) + self.labelnames
+        constant = tuple(value for _, value in constant_labels)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else _format_value(bound)
+                labels = _format_labels(names + ('le',), constant + key + (le,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(names, constant + key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Process-wide metrics
+REQUEST_SECONDS = Histogram(
+    'bookhunt_request_seconds', 'Wall time spent handling a request.', ('endpoint',))
+PHASE_SECONDS = Histogram(
+    'bookhunt_phase_seconds', 'Time spent per request in each instrumented phase.', ('endpoint', 'phase'))
+DB_QUERIES = Histogram(
+    'bookhunt_db_queries_per_request', 'Number of SQL statements executed per request.', ('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS)
+CACHE_REQUESTS = Counter(
+    'bookhunt_cache_requests_total', 'Cache lookups by cache and result (hit/miss).', ('cache', 'result'))
+MODEL_INFERENCES = Counter(
+    'bookhunt_model_inferences_total', 'Forward passes through the embedding model.', ('kind',))
+
+REGISTRY = [REQUEST_SECONDS, PHASE_SECONDS, DB_QUERIES, CACHE_REQUESTS, MODEL_INFERENCES]
+
+
+def record_phase(phase, seconds):
+    """
+    Add ``seconds`` to ``phase`` for the current request.
+
+    Outside a request (e.g. the model being loaded at startup) the value goes
+    straight into the phase histogram instead.
+    """
+    if has_request_context() and hasattr(g, '_phase_timings'):
+        g._phase_timings[phase] = g._phase_timings.get(phase, 0.0) + seconds
+    else:
+        PHASE_SECONDS.observe(seconds, endpoint='', phase=phase)
+
+
+def _phase_stack():
+    stack = getattr(_phases, 'stack', None)
+    if stack is None:
+        stack = _phases.stack = []
+    return stack
+
+
+def _charge_parent(seconds):
+    # Time spent in a nested phase or a SQL statement is not the enclosing phase's own time
+    stack = _phase_stack()
+    if stack:
+        stack[-1][2] += seconds
+
+
+@contextmanager
+def timed(phase):
+    """Context manager timing the enclosed block as ``phase``, excluding nested phases and SQL."""
+    stack = _phase_stack()
+    frame = [phase, time.perf_counter(), 0.0]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - frame[1]
+        record_phase(phase, elapsed - frame[2])
+        _charge_parent(elapsed)
+
+
+def record_cache(cache, hit, count=1):
+    """Count ``count`` lookups against ``cache`` as hits or misses."""
+    CACHE_REQUESTS.inc(count, cache=cache, result='hit' if hit else 'miss')
+
+
+def record_inference(kind, count=1):
+    """Count ``count`` forward passes through the model for ``kind`` inputs."""
+    MODEL_INFERENCES.inc(count, kind=kind)
+
+
+# SQLAlchemy events: time every statement and charge it to the current request
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_start', []).append((context, time.perf_counter()))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['_query_start'].pop()[1]
+    _charge_parent(elapsed)
+    if has_request_context() and hasattr(g, '_phase_timings'):
+        g._phase_timings['db'] = g._phase_timings.get('db', 0.0) + elapsed
+        g._db_query_count += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute doesn't run for a failed statement; drop its start time
+    connection = context.connection
+    if connection is None or context.execution_context is None:
+        return
+    starts = connection.info.get('_query_start')
+    if starts and starts[-1][0] is context.execution_context:
+        starts.pop()
+
+
+def _start_request():
+    g._request_start = time.perf_counter()
+    g._phase_timings = {}
+    g._db_query_count = 0
+
+
+def _finish_request(response):
+    start = getattr(g, '_request_start', None)
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+    endpoint = request.endpoint or 'unknown'
+    timings = g._phase_timings
+    query_count = g._db_query_count
+
+    REQUEST_SECONDS.observe(total, endpoint=endpoint)
+    DB_QUERIES.observe(query_count, endpoint=endpoint)
+    for phase, seconds in timings.items():
+        PHASE_SECONDS.observe(seconds, endpoint=endpoint, phase=phase)
+
+    entries = [f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in timings.items()]
+    entries.append(f'db_queries;desc="{query_count}"')
+    entries.append(f'total;dur={total * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    logger.info('request endpoint=%s status=%s total_ms=%.2f db_queries=%d',
+                endpoint, response.status_code, total * 1000, query_count)
+    return response
+
+
+metrics_api = Blueprint('metrics', __name__)
+
+
+@metrics_api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose all registered metrics of this process in Prometheus text format, labelled with its pid."""
+    constant_labels = (('pid', os.getpid()),)
+    with _lock:
+        lines = []
+        for metric in REGISTRY:
+            lines.extend(metric.expose(constant_labels))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Install the per-request timing hooks and the /metrics endpoint on ``app``."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.register_blueprint(metrics_api)
@@ -0,0 +1,28 @@
+"""Index books.genre_row_id and track catalog versions that edited existing books
+
+Revision ID: 2c9b7f4e5a13
+Revises: 7a1e4c92b0d6
+Create Date: 2026-10-19 12:24:51.903318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c9b7f4e5a13'
+down_revision = '7a1e4c92b0d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_books_genre_row_id', 'books', ['genre_row_id'], unique=False)
+    with op.batch_alter_table('catalog_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rebuilt_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('catalog_state', schema=None) as batch_op:
+        batch_op.drop_column('rebuilt_version')
+    op.drop_index('ix_books_genre_row_id', table_name='books')
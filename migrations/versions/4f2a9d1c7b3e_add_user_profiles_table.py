@@ -0,0 +1,32 @@
+"""Add user_profiles table for the taste vector
+
+Revision ID: 4f2a9d1c7b3e
+Revises: 9c0fb8f9cf1d
+Create Date: 2026-10-19 09:12:41.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9d1c7b3e'
+down_revision = '9c0fb8f9cf1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('user_profiles'):
+        return
+    op.create_table('user_profiles',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('vector_sum', sa.LargeBinary(), nullable=True),
+        sa.Column('weight_total', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_profiles')
@@ -0,0 +1,282 @@
+"""Use integer row ids as primary keys, keeping the UUIDs as unique external ids
+
+Revision ID: 7a1e4c92b0d6
+Revises: d5c3e8a17f90
+Create Date: 2026-10-19 11:32:08.417305
+
+Every table keyed by a UUID string is rebuilt with an ``INTEGER PRIMARY KEY``
+``row_id`` (SQLite's rowid) and the old UUID kept in a unique ``id`` column.
+Foreign keys are rewritten from UUIDs to row ids in the same pass, so joins
+and indexes compare 8-byte integers instead of 36-character strings. Existing
+rows keep their insertion order, and therefore get dense row ids.
+
+The database size and the timing of a user_books/books join and a primary key
+lookup (by UUID before, by row id after) are logged before and after the
+rebuild.
+"""
+import logging
+import time
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1e4c92b0d6'
+down_revision = 'd5c3e8a17f90'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+# Repetitions per timed query
+MEASURE_ROUNDS = 200
+
+
+def _measure(label, join_sql, lookup_sql, lookup_column):
+    conn = op.get_bind()
+    # Pages of dropped tables sit on the freelist until a VACUUM, so only count used pages
+    page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+    used_pages = conn.exec_driver_sql('PRAGMA page_count').scalar() - conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+
+    # The key of the book in the middle of the table, in the form the lookup compares
+    lookup_id = conn.exec_driver_sql(f'SELECT {lookup_column} FROM books ORDER BY rowid LIMIT 1 OFFSET '
+                                     '(SELECT COUNT(*) / 2 FROM books)').scalar()
+
+    start = time.perf_counter()
+    for _ in range(MEASURE_ROUNDS):
+        conn.exec_driver_sql(join_sql).fetchall()
+    join_ms = (time.perf_counter() - start) * 1000 / MEASURE_ROUNDS
+
+    start = time.perf_counter()
+    for _ in range(MEASURE_ROUNDS):
+        conn.exec_driver_sql(lookup_sql, (lookup_id,)).fetchall()
+    lookup_us = (time.perf_counter() - start) * 1e6 / MEASURE_ROUNDS
+
+    logger.info('%s: size=%.1f KiB user_books join=%.3f ms lookup by %s=%.1f us',
+                label, used_pages * page_size / 1024, join_ms, lookup_column, lookup_us)
+
+
+def _measure_uuid_keys(label):
+    _measure(label,
+             'SELECT books.title, user_books.status FROM user_books JOIN books ON user_books.book_id = books.id',
+             'SELECT title FROM books WHERE id = ?',
+             'id')
+
+
+def _measure_row_ids(label):
+    _measure(label,
+             'SELECT books.title, user_books.status FROM user_books JOIN books ON user_books.book_row_id = books.row_id',
+             'SELECT title FROM books WHERE row_id = ?',
+             'row_id')
+
+
+def upgrade():
+    _measure_uuid_keys('before')
+
+    op.execute("""
+        CREATE TABLE genres_new (
+            row_id INTEGER NOT NULL,
+            id VARCHAR(36) NOT NULL,
+            name VARCHAR(50) NOT NULL,
+            PRIMARY KEY (row_id),
+            UNIQUE (id)
+        )""")
+    op.execute('INSERT INTO genres_new (id, name) SELECT id, name FROM genres ORDER BY rowid')
+
+    op.execute("""
+        CREATE TABLE authors_new (
+            row_id INTEGER NOT NULL,
+            id VARCHAR(36) NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            bio TEXT,
+            PRIMARY KEY (row_id),
+            UNIQUE (id)
+        )""")
+    op.execute('INSERT INTO authors_new (id, name, bio) SELECT id, name, bio FROM authors ORDER BY rowid')
+
+    op.execute("""
+        CREATE TABLE books_new (
+            row_id INTEGER NOT NULL,
+            id VARCHAR(36) NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            description TEXT,
+            average_rating FLOAT,
+            published_year INTEGER,
+            number_of_pages INTEGER,
+            subjects JSON,
+            author_row_id INTEGER,
+            genre_row_id INTEGER,
+            PRIMARY KEY (row_id),
+            UNIQUE (id),
+            FOREIGN KEY(author_row_id) REFERENCES authors (row_id),
+            FOREIGN KEY(genre_row_id) REFERENCES genres (row_id)
+        )""")
+    op.execute("""
+        INSERT INTO books_new (id, title, description, average_rating, published_year, number_of_pages,
+                               subjects, author_row_id, genre_row_id)
+        SELECT b.id, b.title, b.description, b.average_rating, b.published_year, b.number_of_pages,
+               b.subjects, a.row_id, g.row_id
+        FROM books b
+        LEFT JOIN authors_new a ON a.id = b.author_id
+        LEFT JOIN genres_new g ON g.id = b.genre_id
+        ORDER BY b.rowid""")
+
+    op.execute("""
+        CREATE TABLE reviews_new (
+            row_id INTEGER NOT NULL,
+            id VARCHAR(36) NOT NULL,
+            rating INTEGER NOT NULL,
+            comment TEXT,
+            created_at DATETIME,
+            book_row_id INTEGER,
+            PRIMARY KEY (row_id),
+            UNIQUE (id),
+            FOREIGN KEY(book_row_id) REFERENCES books (row_id)
+        )""")
+    op.execute("""
+        INSERT INTO reviews_new (id, rating, comment, created_at, book_row_id)
+        SELECT r.id, r.rating, r.comment, r.created_at, b.row_id
+        FROM reviews r LEFT JOIN books_new b ON b.id = r.book_id
+        ORDER BY r.rowid""")
+
+    # A UserBooks row pointing at a missing book can't get a row id; it was already unreachable
+    op.execute("""
+        CREATE TABLE user_books_new (
+            row_id INTEGER NOT NULL,
+            id VARCHAR(36) NOT NULL,
+            book_row_id INTEGER NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            opinion TEXT,
+            feedback VARCHAR(50),
+            PRIMARY KEY (row_id),
+            UNIQUE (id),
+            FOREIGN KEY(book_row_id) REFERENCES books (row_id)
+        )""")
+    op.execute("""
+        INSERT INTO user_books_new (id, book_row_id, status, opinion, feedback)
+        SELECT u.id, b.row_id, u.status, u.opinion, u.feedback
+        FROM user_books u JOIN books_new b ON b.id = u.book_id
+        ORDER BY u.rowid""")
+
+    op.execute("""
+        CREATE TABLE book_neighbors_new (
+            book_row_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            neighbor_row_id INTEGER NOT NULL,
+            score FLOAT NOT NULL,
+            PRIMARY KEY (book_row_id, rank),
+            FOREIGN KEY(book_row_id) REFERENCES books (row_id),
+            FOREIGN KEY(neighbor_row_id) REFERENCES books (row_id)
+        )""")
+    op.execute("""
+        INSERT INTO book_neighbors_new (book_row_id, rank, neighbor_row_id, score)
+        SELECT b.row_id, n.rank, nb.row_id, n.score
+        FROM book_neighbors n
+        JOIN books_new b ON b.id = n.book_id
+        JOIN books_new nb ON nb.id = n.neighbor_id""")
+
+    for table in ('book_neighbors', 'user_books', 'reviews', 'books', 'authors', 'genres'):
+        op.execute(f'DROP TABLE {table}')
+        op.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+    op.execute('CREATE INDEX ix_reviews_book_row_id ON reviews (book_row_id)')
+    op.execute('CREATE INDEX ix_user_books_book_row_id ON user_books (book_row_id)')
+
+    _measure_row_ids('after')
+
+
+def downgrade():
+    op.execute("""
+        CREATE TABLE genres_old (
+            id VARCHAR(36) NOT NULL,
+            name VARCHAR(50) NOT NULL,
+            PRIMARY KEY (id)
+        )""")
+    op.execute('INSERT INTO genres_old (id, name) SELECT id, name FROM genres ORDER BY row_id')
+
+    op.execute("""
+        CREATE TABLE authors_old (
+            id VARCHAR(36) NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            bio TEXT,
+            PRIMARY KEY (id)
+        )""")
+    op.execute('INSERT INTO authors_old (id, name, bio) SELECT id, name, bio FROM authors ORDER BY row_id')
+
+    op.execute("""
+        CREATE TABLE books_old (
+            id VARCHAR(36) NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            description TEXT,
+            average_rating FLOAT,
+            published_year INTEGER,
+            author_id VARCHAR(36),
+            genre_id VARCHAR(36),
+            number_of_pages INTEGER,
+            subjects JSON,
+            PRIMARY KEY (id),
+            FOREIGN KEY(author_id) REFERENCES authors (id),
+            FOREIGN KEY(genre_id) REFERENCES genres (id)
+        )""")
+    op.execute("""
+        INSERT INTO books_old (id, title, description, average_rating, published_year, author_id, genre_id,
+                               number_of_pages, subjects)
+        SELECT b.id, b.title, b.description, b.average_rating, b.published_year, a.id, g.id,
+               b.number_of_pages, b.subjects
+        FROM books b
+        LEFT JOIN authors a ON a.row_id = b.author_row_id
+        LEFT JOIN genres g ON g.row_id = b.genre_row_id
+        ORDER BY b.row_id""")
+
+    op.execute("""
+        CREATE TABLE reviews_old (
+            id VARCHAR(36) NOT NULL,
+            rating INTEGER NOT NULL,
+            comment TEXT,
+            created_at DATETIME,
+            book_id VARCHAR(36),
+            PRIMARY KEY (id),
+            FOREIGN KEY(book_id) REFERENCES books (id)
+        )""")
+    op.execute("""
+        INSERT INTO reviews_old (id, rating, comment, created_at, book_id)
+        SELECT r.id, r.rating, r.comment, r.created_at, b.id
+        FROM reviews r LEFT JOIN books b ON b.row_id = r.book_row_id
+        ORDER BY r.row_id""")
+
+    op.execute("""
+        CREATE TABLE user_books_old (
+            id VARCHAR(36) NOT NULL,
+            book_id VARCHAR(36) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            opinion TEXT,
+            feedback VARCHAR(50),
+            PRIMARY KEY (id),
+            FOREIGN KEY(book_id) REFERENCES books (id)
+        )""")
+    op.execute("""
+        INSERT INTO user_books_old (id, book_id, status, opinion, feedback)
+        SELECT u.id, b.id, u.status, u.opinion, u.feedback
+        FROM user_books u JOIN books b ON b.row_id = u.book_row_id
+        ORDER BY u.row_id""")
+
+    op.execute("""
+        CREATE TABLE book_neighbors_old (
+            book_id VARCHAR(36) NOT NULL,
+            rank INTEGER NOT NULL,
+            neighbor_id VARCHAR(36) NOT NULL,
+            score FLOAT NOT NULL,
+            PRIMARY KEY (book_id, rank),
+            FOREIGN KEY(book_id) REFERENCES books (id),
+            FOREIGN KEY(neighbor_id) REFERENCES books (id)
+        )""")
+    op.execute("""
+        INSERT INTO book_neighbors_old (book_id, rank, neighbor_id, score)
+        SELECT b.id, n.rank, nb.id, n.score
+        FROM book_neighbors n
+        JOIN books b ON b.row_id = n.book_row_id
+        JOIN books nb ON nb.row_id = n.neighbor_row_id""")
+
+    for table in ('book_neighbors', 'user_books', 'reviews', 'books', 'authors', 'genres'):
+        op.execute(f'DROP TABLE {table}')
+        op.execute(f'ALTER TABLE {table}_old RENAME TO {table}')
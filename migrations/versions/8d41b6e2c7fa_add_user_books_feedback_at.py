@@ -0,0 +1,26 @@
+"""Record when the current feedback on a book was given
+
+Revision ID: 8d41b6e2c7fa
+Revises: 2c9b7f4e5a13
+Create Date: 2026-10-19 13:02:17.551204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41b6e2c7fa'
+down_revision = '2c9b7f4e5a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user_books', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('feedback_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user_books', schema=None) as batch_op:
+        batch_op.drop_column('feedback_at')
@@ -0,0 +1,34 @@
+"""Add book_neighbors table for precomputed similar books
+
+Revision ID: b81e5f03a6d2
+Revises: 4f2a9d1c7b3e
+Create Date: 2026-10-19 10:04:17.532906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81e5f03a6d2'
+down_revision = '4f2a9d1c7b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('book_neighbors'):
+        return
+    op.create_table('book_neighbors',
+        sa.Column('book_id', sa.String(length=36), nullable=False),
+        sa.Column('rank', sa.Integer(), nullable=False),
+        sa.Column('neighbor_id', sa.String(length=36), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['book_id'], ['books.id'], ),
+        sa.ForeignKeyConstraint(['neighbor_id'], ['books.id'], ),
+        sa.PrimaryKeyConstraint('book_id', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('book_neighbors')
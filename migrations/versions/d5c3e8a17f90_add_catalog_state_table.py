@@ -0,0 +1,30 @@
+"""Add catalog_state table holding the catalog version counter
+
+Revision ID: d5c3e8a17f90
+Revises: b81e5f03a6d2
+Create Date: 2026-10-19 10:47:55.204113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5c3e8a17f90'
+down_revision = 'b81e5f03a6d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('catalog_state'):
+        return
+    op.create_table('catalog_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('catalog_state')
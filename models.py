@@ -2,13 +2,19 @@ from flask_sqlalchemy import SQLAlchemy
 import uuid
 from datetime import datetime
 from sqlalchemy.dialects.postgresql import JSON
+import numpy as np
 
 db = SQLAlchemy()
 
+# Every table has a dense integer row_id as its primary key (an alias of SQLite's
+# rowid) that is used for joins, indexes and array addressing internally. The
+# UUID in `id` is the stable external identifier used by the API and templates.
+
 class Book(db.Model):
     __tablename__ = 'books'
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    row_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text)
     average_rating = db.Column(db.Float, default=0.0)
@@ -17,8 +23,8 @@ class Book(db.Model):
     subjects = db.Column(JSON, default=[])  # Column to store subjects as a JSON array
     
     # Foreign Keys
-    author_id = db.Column(db.String(36), db.ForeignKey('authors.id'))
-    genre_id = db.Column(db.String(36), db.ForeignKey('genres.id'))
+    author_row_id = db.Column(db.Integer, db.ForeignKey('authors.row_id'))
+    genre_row_id = db.Column(db.Integer, db.ForeignKey('genres.row_id'), index=True)
 
     # Relationships
     author = db.relationship('Author', backref=db.backref('books', lazy=True))
@@ -27,13 +33,14 @@ class Book(db.Model):
 class Review(db.Model):
     __tablename__ = 'reviews'
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    row_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Foreign Keys
-    book_id = db.Column(db.String(36), db.ForeignKey('books.id'))
+    book_row_id = db.Column(db.Integer, db.ForeignKey('books.row_id'), index=True)
 
     # Relationships
     book = db.relationship('Book', backref=db.backref('reviews', lazy=True))
@@ -41,24 +48,61 @@ class Review(db.Model):
 class Genre(db.Model):
     __tablename__ = 'genres'
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    row_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
     name = db.Column(db.String(50), nullable=False)
 
 class Author(db.Model):
     __tablename__ = 'authors'
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    row_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
     name = db.Column(db.String(100), nullable=False)
     bio = db.Column(db.Text)
 
 class UserBooks(db.Model):
     __tablename__ = 'user_books'
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    book_id = db.Column(db.String(36), db.ForeignKey('books.id'), nullable=False)
+    row_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
+    book_row_id = db.Column(db.Integer, db.ForeignKey('books.row_id'), nullable=False, index=True)
     status = db.Column(db.String, nullable=False, default="pending")
     opinion = db.Column(db.Text)
     feedback = db.Column(db.String(50), nullable=True)  
+    feedback_at = db.Column(db.DateTime)  # When the current feedback was given; older events don't overwrite it
 
     # Relationships
-    book = db.relationship('Book', backref=db.backref('user_books', lazy=True))
\ No newline at end of file
+    book = db.relationship('Book', backref=db.backref('user_books', lazy=True))
+
+class UserProfile(db.Model):
+    __tablename__ = 'user_profiles'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    vector_sum = db.Column(db.LargeBinary)  # Weighted sum of book embeddings (float64)
+    weight_total = db.Column(db.Float, nullable=False, default=0.0)  # Sum of absolute weights
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def get_vector_sum(self):
+        return np.frombuffer(self.vector_sum, dtype=np.float64) if self.vector_sum else None
+
+    def set_vector_sum(self, vector):
+        self.vector_sum = np.asarray(vector, dtype=np.float64).tobytes() if vector is not None else None
+
+class BookNeighbor(db.Model):
+    __tablename__ = 'book_neighbors'
+
+    # (book_row_id, rank) is the primary key, so a book's list is one index range scan
+    book_row_id = db.Column(db.Integer, db.ForeignKey('books.row_id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_row_id = db.Column(db.Integer, db.ForeignKey('books.row_id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+    # Relationships
+    neighbor = db.relationship('Book', foreign_keys=[neighbor_row_id])
+
+class CatalogState(db.Model):
+    __tablename__ = 'catalog_state'
+
+    id = db.Column(db.Integer, primary_key=True)  # Single row, id 1
+    version = db.Column(db.Integer, nullable=False, default=0)  # Bumped whenever books are added or changed
+    rebuilt_version = db.Column(db.Integer, nullable=False, default=0)  # Last version that edited or removed existing books
@@ -0,0 +1,211 @@
+"""
+Precomputed "similar books" lists.
+
+The top-K most similar books (cosine over the stored description
+embeddings) are computed offline by ``flask build-neighbors`` and kept in the
+``book_neighbors`` table, so the details page and ``/api/books/<id>/similar``
+only do one indexed lookup.
+
+Books without a real description are left out, both as sources and as
+candidates: they all share the placeholder's embedding, so they would
+otherwise be each other's neighbours with a score of 1.0.
+
+The full build is a blocked matrix multiply over the memory-mapped embedding
+matrix: rows are split into blocks that are scored in parallel, and each row
+block walks the columns in tiles, keeping a running top-K, so memory stays at
+one ``ROW_BLOCK x COL_BLOCK`` tile per worker. After a sync only the books
+affected by the delta are recomputed (see update_neighbors).
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import delete, insert
+
+from models import db, Book, BookNeighbor
+from genres import PLACEHOLDER_DESCRIPTION
+
+logger = logging.getLogger('bookhunt')
+
+DEFAULT_K = 10
+ROW_BLOCK = 256
+COL_BLOCK = 8192
+
+
+def _unit(store, rows):
+    vectors = np.asarray(store.vectors[rows], dtype=np.float32)
+    norms = np.asarray(store.norms[rows], dtype=np.float32)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, None]
+
+
+def _described(store):
+    """Return a mask over the store's rows, False for books without a real description."""
+    undescribed = db.session.query(Book.row_id).filter(
+        Book.description.is_(None) | Book.description.in_(['', PLACEHOLDER_DESCRIPTION]))
+    rows = store.rows_for([row_id for row_id, in undescribed])
+    mask = np.ones(store.rows, dtype=bool)
+    mask[rows[rows >= 0]] = False
+    return mask
+
+
+def _top_k_for_rows(store, rows, k, candidates):
+    """Return (neighbor rows, scores), each len(rows) x k, best first."""
+    query = _unit(store, rows)
+    best_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+    best_rows = np.full((len(rows), k), -1, dtype=np.int64)
+
+    for start in range(0, store.rows, COL_BLOCK):
+        cols = np.arange(start, min(start + COL_BLOCK, store.rows))
+        scores = query @ _unit(store, cols).T
+        # A book is not its own neighbour
+        scores[rows[:, None] == cols[None, :]] = -np.inf
+        scores[:, ~candidates[cols]] = -np.inf
+
+        # Merge this tile's candidates into the running top-k
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_rows = np.concatenate([best_rows, np.broadcast_to(cols, scores.shape)], axis=1)
+        keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+        best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def compute_neighbors(store, rows=None, k=DEFAULT_K, workers=None, candidates=None):
+    """
+    Compute the top-k neighbours of ``rows`` (default: every row) of ``store``.
+
+    Row blocks are scored on a thread pool; NumPy releases the GIL inside the
+    matrix multiply and partitioning, so the blocks run on separate cores.
+
+    Args:
+        candidates (np.ndarray, optional): Mask over the store's rows of the
+            books that can be (and get) neighbours; defaults to the books with
+            a real description.
+
+    Returns:
+        dict: book row id -> list of (neighbor book row id, score), best first.
+    """
+    candidates = _described(store) if candidates is None else candidates
+    rows = np.arange(store.rows) if rows is None else np.asarray(rows, dtype=np.int64)
+    rows = rows[candidates[rows]]
+    k = min(k, int(candidates.sum()) - 1)
+    if k <= 0 or not len(rows):
+        return {}
+
+    blocks = [rows[start:start + ROW_BLOCK] for start in range(0, len(rows), ROW_BLOCK)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = pool.map(lambda block: (block, *_top_k_for_rows(store, block, k, candidates)), blocks)
+
+        neighbors = {}
+        for block, neighbor_rows, scores in results:
+            for row, row_neighbors, row_scores in zip(block, neighbor_rows, scores):
+                neighbors[int(store.row_ids[row])] = [
+                    (int(store.row_ids[n]), float(score))
+                    for n, score in zip(row_neighbors, row_scores) if n >= 0 and np.isfinite(score)
+                ]
+    return neighbors
+
+
+def save_neighbors(neighbors, remove=()):
+    """
+    Replace the stored neighbour lists for the books in ``neighbors`` in one transaction.
+
+    Args:
+        neighbors (dict): book row id -> list of (neighbor book row id, score).
+        remove (iterable): Book row ids whose lists should be dropped entirely.
+    """
+    book_row_ids = list(neighbors) + list(remove)
+    for start in range(0, len(book_row_ids), 500):
+        chunk = book_row_ids[start:start + 500]
+        db.session.execute(delete(BookNeighbor).where(BookNeighbor.book_row_id.in_(chunk)))
+    rows = [
+        {'book_row_id': book_row_id, 'rank': rank, 'neighbor_row_id': neighbor_row_id, 'score': score}
+        for book_row_id, items in neighbors.items()
+        for rank, (neighbor_row_id, score) in enumerate(items)
+    ]
+    if rows:
+        db.session.execute(insert(BookNeighbor), rows)
+    db.session.commit()
+
+
+def build_neighbors(store, k=DEFAULT_K, workers=None):
+    """Recompute and store the neighbour lists for the whole catalog."""
+    neighbors = compute_neighbors(store, k=k, workers=workers)
+    db.session.execute(delete(BookNeighbor))
+    save_neighbors(neighbors)
+    logger.info('neighbors built books=%d k=%d', len(neighbors), k)
+    return len(neighbors)
+
+
+def update_neighbors(store, changed_row_ids, k=DEFAULT_K, workers=None):
+    """
+    Recompute only the neighbour lists a sync delta can have changed.
+
+    A list is recomputed if its book changed, if it contains a changed or
+    removed book, or if a changed book now scores above its current k-th
+    neighbour. A changed book left without a real description loses its list.
+
+    Args:
+        store (EmbeddingStore): The embedding store, already including the delta.
+        changed_row_ids (iterable): Row ids of books added, updated or removed by the sync.
+
+    Returns:
+        int: Number of books whose lists were recomputed.
+    """
+    changed_ids = set(changed_row_ids)
+    candidates = _described(store)
+    lookup = store.rows_for(list(changed_ids))
+    changed_rows = lookup[lookup >= 0]
+    changed_rows = changed_rows[candidates[changed_rows]]
+    removed = {book_row_id for book_row_id, row in zip(changed_ids, lookup) if row < 0 or not candidates[row]}
+
+    # Current lists: which books reference a changed book, and each list's k-th score
+    kth_score = {}
+    affected = set(changed_ids) - removed
+    for book_row_id, neighbor_row_id, rank, score in db.session.query(
+            BookNeighbor.book_row_id, BookNeighbor.neighbor_row_id, BookNeighbor.rank, BookNeighbor.score):
+        if neighbor_row_id in changed_ids:
+            affected.add(book_row_id)
+        if rank == k - 1:
+            kth_score[book_row_id] = score
+
+    # Books that a changed book would now enter the top-k of
+    if len(changed_rows):
+        kth = np.full(store.rows, -np.inf, dtype=np.float32)
+        kth_rows = store.rows_for(list(kth_score))
+        kth[kth_rows[kth_rows >= 0]] = np.array(list(kth_score.values()), dtype=np.float32)[kth_rows >= 0]
+        changed_unit = _unit(store, changed_rows)
+        for start in range(0, store.rows, COL_BLOCK):
+            cols = np.arange(start, min(start + COL_BLOCK, store.rows))
+            scores = _unit(store, cols) @ changed_unit.T
+            scores[cols[:, None] == changed_rows[None, :]] = -np.inf
+            entering = cols[(scores.max(axis=1) > kth[cols]) & candidates[cols]]
+            affected.update(int(row_id) for row_id in store.row_ids[entering])
+
+    affected -= removed
+    rows = store.rows_for(list(affected))
+    neighbors = compute_neighbors(store, rows[rows >= 0], k=k, workers=workers, candidates=candidates)
+    save_neighbors(neighbors, remove=removed)
+    logger.info('neighbors updated changed=%d recomputed=%d removed=%d', len(changed_ids), len(neighbors), len(removed))
+    return len(neighbors)
+
+
+def get_similar_books(book_row_id, limit=DEFAULT_K):
+    """
+    Return the precomputed similar books for the book with ``book_row_id``.
+
+    Returns:
+        list: (Book, score) pairs, most similar first.
+    """
+    return (
+        db.session.query(Book, BookNeighbor.score)
+        .join(BookNeighbor, BookNeighbor.neighbor_row_id == Book.row_id)
+        .filter(BookNeighbor.book_row_id == book_row_id)
+        .order_by(BookNeighbor.rank)
+        .limit(limit)
+        .all()
+    )
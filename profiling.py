@@ -0,0 +1,181 @@
+"""
+On-demand request profiling and the slow SQL log.
+
+Profiling is opt-in twice over: ``PROFILING_ENABLED`` must be set, and the
+request must ask for it with the ``X-Profile`` header or the ``_profile``
+query parameter. The value picks the profiler:
+
+    cprofile  deterministic profile, saved as ``<name>.pstats``
+    sample    wall-clock stack sampler, saved as ``<name>.folded``
+    1 / all   both at once
+
+``.folded`` files are in collapsed-stack format (one ``a;b;c count`` line per
+stack), ready for flamegraph.pl or speedscope. Files are written to
+``instance/profiles/`` and the file stem is returned in ``X-Profile-Id``.
+"""
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('bookhunt')
+slow_sql_logger = logging.getLogger('bookhunt.slow_sql')
+
+PROFILE_MODES = {'cprofile', 'sample', 'all', '1'}
+
+# Slow SQL log settings, filled in by init_profiling
+_slow_query_threshold = None
+_slow_query_sample_rate = 1.0
+
+
+class StackSampler:
+    """Periodically samples the stack of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bookhunt-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+def _requested_mode(app):
+    mode = request.headers.get(app.config['PROFILE_HEADER']) or request.args.get(app.config['PROFILE_QUERY_PARAM'])
+    if not mode:
+        return None
+    mode, _, supplied = mode.strip().partition(':')
+    token = app.config['PROFILE_TOKEN']
+    # With a token configured, the value must be "<mode>:<token>"
+    if token and supplied != token:
+        return None
+    mode = mode.lower()
+    return mode if mode in PROFILE_MODES else None
+
+
+def _start_profile(app):
+    mode = _requested_mode(app)
+    if mode is None:
+        return
+    g._profile_mode = mode
+    g._profile_started = time.perf_counter()
+    if mode in ('sample', 'all', '1'):
+        g._profile_sampler = StackSampler(threading.get_ident(), app.config['PROFILE_SAMPLE_INTERVAL'])
+        g._profile_sampler.start()
+    if mode in ('cprofile', 'all', '1'):
+        g._profile_cprofile = cProfile.Profile()
+        g._profile_cprofile.enable()
+
+
+def _finish_profile(app, response):
+    mode = getattr(g, '_profile_mode', None)
+    if mode is None:
+        return response
+
+    profiler = getattr(g, '_profile_cprofile', None)
+    if profiler is not None:
+        profiler.disable()
+    sampler = getattr(g, '_profile_sampler', None)
+    if sampler is not None:
+        sampler.stop()
+    elapsed = time.perf_counter() - g._profile_started
+
+    profile_dir = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    name = f'{stamp}-{request.endpoint or "unknown"}-{os.getpid()}'
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(profile_dir, name + '.pstats'))
+    if sampler is not None:
+        sampler.write_collapsed(os.path.join(profile_dir, name + '.folded'))
+
+    logger.info('profile saved name=%s mode=%s path=%s elapsed_ms=%.2f',
+                name, mode, request.full_path, elapsed * 1000)
+    response.headers['X-Profile-Id'] = name
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _slow_query_start(conn, cursor, statement, parameters, context, executemany):
+    # Only a sample of statements is timed, so the log can stay on in production
+    sampled = _slow_query_threshold is not None and random.random() < _slow_query_sample_rate
+    conn.info.setdefault('_slow_query_start', []).append((context, time.perf_counter() if sampled else None))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _slow_query_end(conn, cursor, statement, parameters, context, executemany):
+    _, start = conn.info['_slow_query_start'].pop()
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if elapsed >= _slow_query_threshold:
+        params = repr(parameters)
+        if len(params) > 500:
+            params = params[:500] + '...'
+        slow_sql_logger.warning('slow query duration_ms=%.2f statement=%r parameters=%s',
+                                elapsed * 1000, ' '.join(statement.split()), params)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _slow_query_error(context):
+    # A statement that raised never reaches after_cursor_execute; drop its entry
+    connection = context.connection
+    if connection is None or context.execution_context is None:
+        return
+    starts = connection.info.get('_slow_query_start')
+    if starts and starts[-1][0] is context.execution_context:
+        starts.pop()
+
+
+def init_profiling(app):
+    """Install the profiling hooks and configure the slow SQL log for ``app``."""
+    global _slow_query_threshold, _slow_query_sample_rate
+
+    threshold_ms = app.config['SLOW_QUERY_THRESHOLD_MS']
+    _slow_query_threshold = threshold_ms / 1000 if threshold_ms is not None else None
+    _slow_query_sample_rate = app.config['SLOW_QUERY_SAMPLE_RATE']
+
+    log_file = app.config['SLOW_QUERY_LOG_FILE']
+    if _slow_query_threshold is not None and log_file and not slow_sql_logger.handlers:
+        if not os.path.isabs(log_file):
+            log_file = os.path.join(app.instance_path, log_file)
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_sql_logger.addHandler(handler)
+
+    if app.config['PROFILING_ENABLED']:
+        app.before_request(lambda: _start_profile(app))
+        app.after_request(lambda response: _finish_profile(app, response))
@@ -0,0 +1,141 @@
+"""
+Server-side cursors over a computed ranking.
+
+When recommendations are computed for a query, the top
+``RANKING_CURSOR_DEPTH`` book row ids are saved behind a random token. Each
+"next" walks that list instead of re-running the whole pipeline, skipping
+books rejected since the ranking was computed. A cursor is only recomputed
+once it is exhausted, has expired (``RANKING_CURSOR_TTL``), was built from
+an older catalog version or is asked for a different query or genre. The
+ranking that replaces an exhausted cursor leaves out every book the earlier
+cursors in the sequence covered, kept in ``excluded_ids``.
+
+Cursors are small JSON files in ``instance/ranking_cursors/`` so every worker
+process can serve every cursor.
+"""
+import json
+import logging
+import os
+import secrets
+import time
+
+from flask import current_app
+
+logger = logging.getLogger('bookhunt')
+
+# Time of the last sweep for expired cursor files in this process
+_last_cleanup = 0.0
+
+
+def _cursor_dir():
+    path = current_app.config['RANKING_CURSOR_DIR'] or os.path.join(current_app.instance_path, 'ranking_cursors')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _cursor_path(token):
+    return os.path.join(_cursor_dir(), f'{token}.json')
+
+
+def save_cursor(token, cursor):
+    """Write ``cursor`` for ``token``, replacing any previous state atomically."""
+    path = _cursor_path(token)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(cursor, f)
+    os.replace(tmp_path, path)
+
+
+def create_cursor(query, genre, ranked_ids, catalog_version, position=0, excluded_ids=()):
+    """
+    Save a new cursor over ``ranked_ids``.
+
+    Args:
+        query (str): The query the ranking was computed for.
+        genre (str): The genre filter the ranking was computed with.
+        ranked_ids (list): Book row ids, best first.
+        catalog_version (int): Catalog version the ranking was computed from.
+        position (int, optional): Index of the next book to serve.
+        excluded_ids (list, optional): Book row ids the ranking left out
+            because earlier cursors in the sequence already covered them.
+
+    Returns:
+        str: The cursor token.
+    """
+    _cleanup_expired()
+    token = secrets.token_urlsafe(16)
+    save_cursor(token, {
+        'query': query,
+        'genre': genre,
+        'ranked_ids': list(ranked_ids),
+        'position': position,
+        'excluded_ids': list(excluded_ids),
+        'catalog_version': catalog_version,
+        'created_at': time.time(),
+    })
+    return token
+
+
+def load_cursor(token):
+    """
+    Return the cursor for ``token``, or None if it is unknown or expired.
+    """
+    if not token or not token.replace('-', '').replace('_', '').isalnum():
+        return None
+    try:
+        with open(_cursor_path(token)) as f:
+            cursor = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cursor['created_at'] > current_app.config['RANKING_CURSOR_TTL']:
+        delete_cursor(token)
+        return None
+    return cursor
+
+
+def delete_cursor(token):
+    try:
+        os.remove(_cursor_path(token))
+    except OSError:
+        pass
+
+
+def advance_cursor(token, cursor, excluded_ids):
+    """
+    Return the next book row id from ``cursor``, skipping ``excluded_ids``.
+
+    The new position is saved. Returns None once the list is exhausted.
+    """
+    ranked_ids = cursor['ranked_ids']
+    position = cursor['position']
+    while position < len(ranked_ids) and ranked_ids[position] in excluded_ids:
+        position += 1
+    if position >= len(ranked_ids):
+        cursor['position'] = position
+        save_cursor(token, cursor)
+        return None
+    cursor['position'] = position + 1
+    save_cursor(token, cursor)
+    return ranked_ids[position]
+
+
+def _cleanup_expired():
+    # Sweep at most once per TTL per process
+    global _last_cleanup
+    ttl = current_app.config['RANKING_CURSOR_TTL']
+    now = time.time()
+    if now - _last_cleanup < ttl:
+        return
+    _last_cleanup = now
+    directory = _cursor_dir()
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.debug('ranking cursors expired count=%d', removed)
@@ -1,26 +1,159 @@
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import threading
+import time
 from transformers import BertTokenizer, BertModel
 import torch
 from models import db, Book, UserBooks
-import random
+from metrics import timed, record_cache, record_inference
+from taste import book_weight, apply_taste_delta
+from embedding_store import get_embedding_store, open_embedding_store, write_embedding_store
+from catalog_snapshot import get_catalog_snapshot, load_books
 import numpy as np
 
-# Initialize the BERT tokenizer and model
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-model = BertModel.from_pretrained('bert-base-uncased')
+logger = logging.getLogger('bookhunt')
 
-def get_bert_embeddings(text):
+MODEL_NAME = 'bert-base-uncased'
+
+# The BERT tokenizer and model, loaded on first use (see load_model)
+tokenizer = None
+model = None
+
+# Book description embeddings keyed by (book row id, description), most recently used last
+BOOK_EMBEDDING_CACHE_SIZE = 10000
+_book_embedding_cache = OrderedDict()
+_book_embedding_cache_lock = threading.Lock()  # The dev server is threaded; guards every cache access
+
+# How strongly the user's taste profile pulls the ranking (added to the query similarity)
+TASTE_WEIGHT = 0.2
+
+# Maximum number of ids per "IN (...)" lookup, below SQLite's bound-parameter limit
+IN_CHUNK_SIZE = 500
+
+# Embedding rows gathered from the embedding file per matrix multiply when scoring
+SCORE_BLOCK = 8192
+
+def load_model():
+    """Load the BERT tokenizer and model if they haven't been loaded yet."""
+    global tokenizer, model
+    if model is None:
+        with timed('model_load'):
+            tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
+            model = BertModel.from_pretrained(MODEL_NAME)
+        logger.info('model loaded name=%s', MODEL_NAME)
+    return tokenizer, model
+
+def get_bert_embeddings(text, kind='query'):
     """Generate BERT embeddings for the input text."""
+    tokenizer, model = load_model()
+
     # Tokenize the input text and convert it into input tensors
     inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512)
     
     # Get the model's output
     with torch.no_grad():
         outputs = model(**inputs)
+    record_inference(kind)
 
     # Extract the embeddings from the [CLS] token
     embeddings = outputs.last_hidden_state[:, 0, :].squeeze().numpy()
     return embeddings
 
+def encode_texts(texts, kind='book'):
+    """
+    Generate BERT embeddings for a batch of texts in a single forward pass.
+
+    Returns:
+        np.ndarray: A len(texts) x dim matrix of [CLS] embeddings.
+    """
+    tokenizer, model = load_model()
+    inputs = tokenizer(texts, return_tensors='pt', padding=True, truncation=True, max_length=512)
+    with torch.no_grad():
+        outputs = model(**inputs)
+    record_inference(kind, len(texts))
+    return outputs.last_hidden_state[:, 0, :].numpy()
+
+def book_description(book):
+    """Return the text a book is embedded from."""
+    # Ensure the book has a valid description (fallback to default description if missing)
+    return book.description if book.description else "No description available"
+
+def get_book_embeddings(book):
+    """Return the description embeddings for a book, reusing stored or cached values when possible."""
+    # Precomputed vectors from the shared embedding file come first
+    store = get_embedding_store(MODEL_NAME)
+    if store is not None:
+        embeddings = store.get(book.row_id)
+        record_cache('embedding_store', embeddings is not None)
+        if embeddings is not None:
+            return embeddings
+
+    return _description_embeddings(book.row_id, book_description(book))
+
+def _description_embeddings(book_row_id, description):
+    """Return the embeddings of a book's description from the in-process cache, encoding it on a miss."""
+    key = (book_row_id, description)
+
+    with _book_embedding_cache_lock:
+        embeddings = _book_embedding_cache.get(key)
+        if embeddings is not None:
+            _book_embedding_cache.move_to_end(key)
+    record_cache('book_embedding', embeddings is not None)
+    if embeddings is not None:
+        return embeddings
+
+    # Encoded outside the lock so a slow miss doesn't hold up hits in other threads
+    with timed('encode_books'):
+        embeddings = get_bert_embeddings(description, kind='book')
+    with _book_embedding_cache_lock:
+        _book_embedding_cache[key] = embeddings
+        _book_embedding_cache.move_to_end(key)
+        if len(_book_embedding_cache) > BOOK_EMBEDDING_CACHE_SIZE:
+            _book_embedding_cache.popitem(last=False)
+    return embeddings
+
+def build_embedding_store(path, books, batch_size=32, dtype=np.float32, incremental=False, progress=None):
+    """
+    Encode ``books`` and swap in a new embedding file at ``path``.
+
+    Args:
+        path (str): Embedding file path.
+        books (list): Every book the new file should contain.
+        batch_size (int, optional): Books encoded per forward pass.
+        dtype (optional): np.float32 or np.float16.
+        incremental (bool, optional): Reuse vectors already in the current file
+            and only encode books missing from it.
+        progress (callable, optional): Called with (encoded, total) after each batch.
+
+    Returns:
+        list: Row ids of the books that were (re-)encoded.
+    """
+    existing = open_embedding_store(path) if incremental else None
+    if existing is not None and existing.model_id != MODEL_NAME:
+        existing = None
+
+    vectors = np.zeros((len(books), existing.dim if existing else model_dim()), dtype=np.float32)
+    to_encode = list(range(len(books)))
+    if existing is not None:
+        rows = existing.rows_for([book.row_id for book in books])
+        vectors[rows >= 0] = existing.vectors[rows[rows >= 0]]
+        to_encode = [i for i, row in enumerate(rows) if row < 0]
+
+    for start in range(0, len(to_encode), batch_size):
+        batch = to_encode[start:start + batch_size]
+        vectors[batch] = encode_texts([book_description(books[i]) for i in batch])
+        if progress:
+            progress(min(start + batch_size, len(to_encode)), len(to_encode))
+
+    write_embedding_store(path, MODEL_NAME, [book.row_id for book in books], vectors, dtype=dtype)
+    return [books[i].row_id for i in to_encode]
+
+def model_dim():
+    """Return the dimension of the model's embeddings."""
+    _, model = load_model()
+    return model.config.hidden_size
+
 def cosine_similarity(embeddings1, embeddings2):
     """Calculate the cosine similarity between two embedding vectors."""
     if embeddings1 is None or embeddings2 is None:
@@ -30,104 +163,247 @@ def cosine_similarity(embeddings1, embeddings2):
     norm2 = np.linalg.norm(embeddings2)
     return dot_product / (norm1 * norm2) if norm1 and norm2 else 0
 
-def get_recommendations(query, books, user_books, genre=None, top_n=10):
+def get_recommendations(query, user_books, genre=None, top_n=10, taste_vector=None, excluded_row_ids=()):
     """
     Generate book recommendations based on the user's query, considering the book descriptions, genre, etc.
+
+    The candidate books (the genre's partition of the catalog snapshot, or the
+    whole snapshot) are scored in one vectorised pass; only the top_n books
+    are loaded from the database.
     
     Args:
         query (str): Search query from the user.
-        books (list): List of books to recommend from.
         user_books (list): Books that the user has already read or interacted with.
         genre (str, optional): Genre to filter recommendations.
         top_n (int, optional): Number of top recommendations to return.
+        taste_vector (np.ndarray, optional): Unit-length taste profile (see taste.get_taste_vector).
+        excluded_row_ids (iterable, optional): Row ids of further books to leave out.
         
     Returns:
         list: A list of recommended books.
     """
-    if not query:
+    if not query or top_n <= 0:
         return []
 
     # Process the query with BERT
-    query_embeddings = get_bert_embeddings(query)
+    with timed('encode_query'):
+        query_embeddings = get_bert_embeddings(query)
 
-    # Generate a list of books with similarity scores
-    recommendations = []
+    snapshot = get_catalog_snapshot()
 
-    for book in books:
-        # Skip books the user has already read or interacted with
-        if book.id in [ub.book_id for ub in user_books]:
-            continue
+    # Skip books the user has already read or interacted with, and any excluded ones
+    excluded = {ub.book_row_id for ub in user_books}
+    excluded.update(excluded_row_ids)
 
-        # Filter by genre if applicable
-        if genre and genre != book.genre:
-            continue
+    with timed('score'):
+        # Filter by genre if applicable: only that partition of the catalog is scored
+        candidates = snapshot.genre_rows(genre) if genre else np.arange(len(snapshot))
+        if excluded:
+            candidates = candidates[~np.isin(snapshot.row_ids[candidates], list(excluded))]
 
-        # Ensure the book has a valid description (fallback to default description if missing)
-        description = book.description if book.description else "No description available"
+        scores = _score_snapshot(query, query_embeddings, snapshot, candidates, taste_vector)
 
-        # Get BERT embeddings for the book description
-        book_embeddings = get_bert_embeddings(description)
+        # The top_n books by similarity score, best first
+        top = np.arange(len(candidates))
+        if len(top) > top_n:
+            top = np.argpartition(-scores, top_n - 1)[:top_n]
+        top = top[np.argsort(-scores[top], kind='stable')]
 
-        # Compute cosine similarity between the query and book description embeddings
-        similarity = cosine_similarity(query_embeddings, book_embeddings)
+    return load_books(snapshot.row_ids[candidates[top]])
 
-        # Optionally consider book's number of pages or subjects in recommendations
-        if book.number_of_pages:
-            similarity += np.log(book.number_of_pages + 1) / 500  # Apply a logarithmic scale to number of pages
-        
-        if book.subjects:
-            # Boost similarity if the book's subjects match the query
-            for subject in book.subjects:
-                if subject.lower() in query.lower():
-                    similarity += 0.1  # Small boost for subject match
+def _score_snapshot(query, query_embeddings, snapshot, rows, taste_vector):
+    """
+    Score the books at ``rows`` of ``snapshot`` against the query.
 
-        # Add the book and its adjusted similarity score to the recommendations
-        recommendations.append((book, similarity))
+    Returns:
+        np.ndarray: Similarity per entry of ``rows``.
+    """
+    targets = [query_embeddings] if taste_vector is None else [query_embeddings, taste_vector]
+    dots, norms = _catalog_dots(snapshot, rows, np.stack(targets).astype(np.float32))
+
+    # Cosine similarity between the query and each book description, 0 for zero vectors
+    denominators = norms * np.linalg.norm(query_embeddings)
+    scores = np.divide(dots[:, 0], denominators, out=np.zeros(len(rows), dtype=np.float32),
+                       where=denominators > 0)
+
+    # Blend in the user's taste profile
+    if taste_vector is not None:
+        denominators = norms * np.linalg.norm(taste_vector)
+        scores += TASTE_WEIGHT * np.divide(dots[:, 1], denominators, out=np.zeros(len(rows), dtype=np.float32),
+                                           where=denominators > 0)
+
+    # Logarithmic boost for the number of pages, and a small boost per subject named in the query
+    scores += snapshot.page_boost[rows]
+    scores += 0.1 * snapshot.subject_matches(query, rows)
+    return scores
+
+def _catalog_dots(snapshot, rows, targets):
+    """
+    Return the dot products of the embeddings of the books at ``rows`` of ``snapshot`` with ``targets``.
+
+    Vectors come from the shared embedding file in blocks; books missing from
+    it fall back to the in-process cache (or are encoded).
+
+    Returns:
+        tuple: (len(rows) x len(targets) dot products, embedding norm per book).
+    """
+    dots = np.zeros((len(rows), len(targets)), dtype=np.float32)
+    norms = np.zeros(len(rows), dtype=np.float32)
+    missing = range(len(rows))
 
-    # Sort the books by similarity score and return only the top recommendation
-    recommendations.sort(key=lambda x: x[1], reverse=True)
+    store = get_embedding_store(MODEL_NAME)
+    if store is not None:
+        rows_in_store = store.rows_for(snapshot.row_ids[rows])
+        found = np.flatnonzero(rows_in_store >= 0)
+        record_cache('embedding_store', True, len(found))
+        for start in range(0, len(found), SCORE_BLOCK):
+            block = found[start:start + SCORE_BLOCK]
+            dots[block] = np.asarray(store.vectors[rows_in_store[block]], dtype=np.float32) @ targets.T
+        norms[found] = store.norms[rows_in_store[found]]
+        missing = np.flatnonzero(rows_in_store < 0)
+        record_cache('embedding_store', False, len(missing))
 
-    # Return only the top recommendation (just one book)
-    return [recommendations[0][0]] if recommendations else []
+    for i in missing:
+        row = rows[i]
+        embeddings = np.asarray(_description_embeddings(int(snapshot.row_ids[row]), snapshot.description(row)),
+                                dtype=np.float32)
+        dots[i] = targets @ embeddings
+        norms[i] = np.linalg.norm(embeddings)
+    return dots, norms
 
-def record_feedback(book, feedback):
+def record_feedback(book_id, feedback, status='pending'):
     """
-    Record feedback on a book (e.g., liked or rejected).
+    Record feedback on a book (e.g., accepted or rejected) and update the taste profile.
+
+    Accepted books are moved to the reading list ('to_read').
     
     Args:
-        book (Book): Book being reviewed.
-        feedback (str): User's feedback ('like', 'reject', etc.)
+        book_id (str): ID of the book being reviewed.
+        feedback (str): User's feedback ('accept', 'reject', etc.)
+        status (str, optional): Status for a new entry when the feedback isn't 'accept'.
     """
-    user_book = UserBooks.query.filter_by(book_id=book.id).first()
+    apply_feedback(book_id, feedback, status)
+    db.session.commit()
 
-    if user_book:
-        user_book.feedback = feedback
-    else:
-        # Set a default status for new entries, e.g., 'pending'
-        user_book = UserBooks(book_id=book.id, feedback=feedback, status='pending')  # Ensure status is set
-        db.session.add(user_book)
+def apply_feedback(book_id, feedback, status='pending'):
+    """Apply feedback like record_feedback, but leave committing to the caller."""
+    return apply_feedback_batch([(book_id, feedback, status)])[0]
 
-    db.session.commit()
+def apply_feedback_batch(items, event_times=None):
+    """
+    Apply many feedback events with set-wise lookups, leaving committing to the caller.
+
+    Args:
+        items (list): (book_id, feedback, status) tuples, applied in order.
+        event_times (list, optional): Unix time each event was given at (default: now).
+            An event older than the feedback already stored for its book is skipped,
+            so write-behind batches from several workers can be committed in any order.
+
+    Returns:
+        list: 'created', 'updated', 'stale' or 'not_found' per item.
+    """
+    # Resolve the external ids to books, then their UserBooks rows by row id
+    book_ids = list({book_id for book_id, _, _ in items})
+    books = {}
+    for chunk in chunked(book_ids):
+        for book in Book.query.filter(Book.id.in_(chunk)):
+            books[book.id] = book
+    user_books = {}
+    for chunk in chunked([book.row_id for book in books.values()]):
+        for user_book in UserBooks.query.filter(UserBooks.book_row_id.in_(chunk)):
+            user_books.setdefault(user_book.book_row_id, user_book)
 
-def generate_new_recommendations(query, books, user_books, genre=None, top_n=10):
+    if event_times is None:
+        event_times = [time.time()] * len(items)
+
+    results = []
+    taste_changes = []
+    for (book_id, feedback, status), event_time in zip(items, event_times):
+        book = books.get(book_id)
+        if book is None:
+            results.append('not_found')
+            continue
+        user_book = user_books.get(book.row_id)
+        old_status, old_feedback = (user_book.status, user_book.feedback) if user_book else (None, None)
+        given_at = datetime.utcfromtimestamp(event_time)
+
+        if user_book and user_book.feedback_at and user_book.feedback_at > given_at:
+            results.append('stale')
+            continue
+        if user_book:
+            user_book.feedback = feedback
+            user_book.feedback_at = given_at
+            # Update the status if the feedback is 'accept'
+            if feedback == 'accept' and user_book.status != 'to_read':
+                user_book.status = 'to_read'
+            results.append('updated')
+        else:
+            # Set a default status for new entries, e.g., 'pending'
+            user_book = UserBooks(
+                book_row_id=book.row_id,
+                feedback=feedback,
+                feedback_at=given_at,
+                status='to_read' if feedback == 'accept' else status
+            )
+            db.session.add(user_book)
+            user_books[book.row_id] = user_book
+            results.append('created')
+
+        taste_changes.append((book, old_status, old_feedback, user_book.status, user_book.feedback))
+
+    update_taste_batch(taste_changes)
+    return results
+
+def update_taste(book, old_status, old_feedback, new_status, new_feedback):
+    """
+    Apply a UserBooks state change for ``book`` to the taste profile in O(dim).
+
+    The caller commits the change together with the UserBooks row.
+    """
+    update_taste_batch([(book, old_status, old_feedback, new_status, new_feedback)])
+
+def update_taste_batch(changes):
+    """
+    Apply several UserBooks state changes to the taste profile with one profile update.
+
+    Args:
+        changes (list): (book, old_status, old_feedback, new_status, new_feedback) tuples.
+    """
+    vector_delta, weight_delta = None, 0.0
+    for book, old_status, old_feedback, new_status, new_feedback in changes:
+        old_weight = book_weight(book, old_status, old_feedback)
+        new_weight = book_weight(book, new_status, new_feedback)
+        if old_weight == new_weight:
+            continue
+        contribution = (new_weight - old_weight) * np.asarray(get_book_embeddings(book), dtype=np.float64)
+        vector_delta = contribution if vector_delta is None else vector_delta + contribution
+        weight_delta += abs(new_weight) - abs(old_weight)
+    if vector_delta is not None:
+        apply_taste_delta(vector_delta, weight_delta)
+
+def chunked(items, size=IN_CHUNK_SIZE):
+    """Yield successive slices of ``items`` of at most ``size`` elements."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def generate_new_recommendations(query, user_books, genre=None, top_n=10, taste_vector=None, excluded_row_ids=()):
     """
     Generate new recommendations, avoiding books that have been rejected.
     
     Args:
         query (str): Search query to base recommendations on.
-        books (list): List of available books for recommendations.
         user_books (list): Books already read or interacted with.
         genre (str, optional): Genre to filter recommendations.
         top_n (int, optional): Number of top recommendations to return.
+        taste_vector (np.ndarray, optional): Unit-length taste profile.
+        excluded_row_ids (iterable, optional): Row ids of further books to leave out.
         
     Returns:
         list: A list of new recommended books.
     """
     # If a book has been rejected previously, avoid it
-    rejected_books = [ub.book_id for ub in user_books if ub.feedback == 'reject']
-
-    # Filter out the rejected books from the recommendations
-    valid_books = [book for book in books if book.id not in rejected_books]
+    rejected_books = {ub.book_row_id for ub in user_books if ub.feedback == 'reject'}
+    rejected_books.update(excluded_row_ids)
 
     # Generate new recommendations with updated filtering
-    return get_recommendations(query, valid_books, genre, top_n)
+    return get_recommendations(query, user_books, genre, top_n, taste_vector, rejected_books)
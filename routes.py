@@ -1,13 +1,29 @@
-from flask import Blueprint, request, jsonify
+import csv
+import io
+import logging
+from itertools import islice
+from flask import Blueprint, request, jsonify, current_app
 from models import db, Book, UserBooks
-from recommendations import generate_new_recommendations  # Import the recommendation function
+from recommendations import generate_new_recommendations, get_recommendations as rank_books, record_feedback, update_taste, update_taste_batch, apply_feedback_batch, chunked  # Import the recommendation function
+from taste import get_taste_vector
+from feedback_queue import get_feedback_queue, pending_rejections, rejected_row_ids, known_book_ids
+from metrics import timed
+from neighbors import get_similar_books, DEFAULT_K
+from catalog import get_catalog_version, bump_catalog_version
+from catalog_snapshot import get_catalog_snapshot
+from ranking_cursor import create_cursor, load_cursor, advance_cursor, delete_cursor
 
 api = Blueprint('api', __name__)
 
+logger = logging.getLogger('bookhunt')
+
+# Rows parsed from an uploaded CSV before their titles are looked up together
+IMPORT_CHUNK_SIZE = 1000
+
 @api.route('/api/past_reads', methods=['POST'])
 def add_past_read():
     data = request.get_json()
-    print(f"Received data: {data}")  # Debugging line to log the incoming request data
+    logger.debug('past_reads received data=%r', data)
 
     book_title = data.get('book_title')  # User-provided title
     opinion = data.get('opinion', '')  # Opinion is optional
@@ -25,25 +41,158 @@ def add_past_read():
         # If the book doesn't exist, create a new book in the Book table
         book = Book(title=book_title)
         db.session.add(book)
+        bump_catalog_version()
         db.session.commit()
 
     # Check if the book is already in the UserBooks table
-    user_book = UserBooks.query.filter_by(book_id=book.id).first()
+    user_book = UserBooks.query.filter_by(book_row_id=book.row_id).first()
 
     if user_book:
         # If it exists, update the status and opinion
+        update_taste(book, user_book.status, user_book.feedback, status, user_book.feedback)
         user_book.status = status
         user_book.opinion = opinion
         db.session.commit()
         return jsonify({'message': 'Book status and opinion updated successfully'}), 200
     else:
         # If it doesn't exist, add a new entry
-        new_user_book = UserBooks(book_id=book.id, status=status, opinion=opinion)
+        new_user_book = UserBooks(book_row_id=book.row_id, status=status, opinion=opinion)
         db.session.add(new_user_book)
+        update_taste(book, None, None, status, None)
         db.session.commit()
         return jsonify({'message': 'Past read added successfully'}), 201
 
 
+def import_past_reads(entries):
+    """
+    Add or update many past reads with set-wise lookups, leaving committing to the caller.
+
+    Behaves like add_past_read for each entry: unknown titles become new books
+    and existing UserBooks rows are moved to 'read'.
+
+    Args:
+        entries (list): (book_title, opinion) tuples.
+
+    Returns:
+        list: Per-entry result dicts.
+    """
+    titles = list({title for title, _ in entries if title})
+
+    # Resolve every title in one query per chunk, keeping the first match like .first() did
+    books = {}
+    for chunk in chunked(titles):
+        for book in Book.query.filter(Book.title.in_(chunk)):
+            books.setdefault(book.title, book)
+
+    # Create the books that don't exist yet
+    new_books = [Book(title=title) for title in titles if title not in books]
+    if new_books:
+        db.session.add_all(new_books)
+        db.session.flush()  # Assigns ids
+        books.update((book.title, book) for book in new_books)
+        bump_catalog_version()
+    created_titles = {book.title for book in new_books}
+
+    user_books = {}
+    book_row_ids = list({book.row_id for book in books.values()})
+    for chunk in chunked(book_row_ids):
+        for user_book in UserBooks.query.filter(UserBooks.book_row_id.in_(chunk)):
+            user_books.setdefault(user_book.book_row_id, user_book)
+
+    results = []
+    taste_changes = []
+    for title, opinion in entries:
+        if not title:
+            results.append({'book_title': title, 'error': 'book_title is required'})
+            continue
+        book = books[title]
+        user_book = user_books.get(book.row_id)
+        if user_book:
+            taste_changes.append((book, user_book.status, user_book.feedback, 'read', user_book.feedback))
+            user_book.status = 'read'
+            user_book.opinion = opinion
+            result = 'updated'
+        else:
+            user_book = UserBooks(book_row_id=book.row_id, status='read', opinion=opinion)
+            db.session.add(user_book)
+            user_books[book.row_id] = user_book
+            taste_changes.append((book, None, None, 'read', None))
+            result = 'created'
+        results.append({'book_title': title, 'book_id': book.id, 'result': result,
+                        'book_created': title in created_titles})
+
+    update_taste_batch(taste_changes)
+    return results
+
+
+@api.route('/api/past_reads/batch', methods=['POST'])
+def add_past_reads_batch():
+    """
+    Add or update many past reads in a single transaction.
+
+    Expects a JSON array of {"book_title": ..., "opinion": ...} objects and
+    returns one result per item, in order.
+    """
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({'error': 'Expected a JSON array of past reads'}), 400
+
+    results = [None] * len(data)
+    entries = []
+    positions = []
+    for i, item in enumerate(data):
+        if not isinstance(item, dict):
+            item = {}
+        title = item.get('book_title') or ''
+        opinion = item.get('opinion', '')
+        if not isinstance(title, str) or not (opinion is None or isinstance(opinion, str)):
+            results[i] = {'error': 'book_title and opinion must be strings'}
+            continue
+        entries.append((title.strip(), opinion))
+        positions.append(i)
+
+    for i, result in zip(positions, import_past_reads(entries)):
+        results[i] = result
+    db.session.commit()
+
+    return jsonify({'results': results}), 200
+
+
+@api.route('/api/past_reads/import', methods=['POST'])
+def import_past_reads_csv():
+    """
+    Import past reads from a Goodreads-style CSV export.
+
+    Accepts the file as a multipart upload ("file") or as a raw text/csv
+    body. Rows are streamed in chunks; only rows on the "read" shelf are
+    imported (all rows if there is no "Exclusive Shelf" column), using
+    "Title" and "My Review". Everything is committed in one transaction.
+    """
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    if not reader.fieldnames or 'Title' not in reader.fieldnames:
+        return jsonify({'error': 'CSV must have a "Title" column'}), 400
+
+    results = []
+    skipped = 0
+    while True:
+        rows = list(islice(reader, IMPORT_CHUNK_SIZE))
+        if not rows:
+            break
+        entries = []
+        for row in rows:
+            shelf = (row.get('Exclusive Shelf') or 'read').strip()
+            if shelf != 'read':
+                skipped += 1
+                continue
+            entries.append(((row.get('Title') or '').strip(), row.get('My Review') or ''))
+        results.extend(import_past_reads(entries))
+    db.session.commit()
+
+    return jsonify({'results': results, 'skipped': skipped}), 200
+
+
 @api.route('/api/past_reads', methods=['GET'])
 def view_past_reads():
     # Get pagination parameters
@@ -55,11 +204,14 @@ def view_past_reads():
     except Exception as e:
         return jsonify({'error': f'Error during pagination: {str(e)}'}), 500
 
+    # Load the page's books in one query instead of one per row
+    book_row_ids = [user_book.book_row_id for user_book in user_books_paginated.items]
+    books = {book.row_id: book for book in Book.query.filter(Book.row_id.in_(book_row_ids))} if book_row_ids else {}
+
     # Serialize paginated results
     result = []
     for user_book in user_books_paginated.items:
-        # Get the book by ID
-        book = Book.query.get(user_book.book_id)
+        book = books.get(user_book.book_row_id)
         if book:
             result.append({
                 'id': user_book.id,
@@ -98,28 +250,67 @@ def feedback():
     feedback = data['feedback']  # 'accept', 'reject', or other types of feedback
     status = data.get("status", "pending")  # Default to "pending" if not provided
 
-    # Check if the book already exists in the user's records
-    user_book = UserBooks.query.filter_by(book_id=book_id).first()
+    if not all(isinstance(value, str) for value in (book_id, feedback, status)):
+        return jsonify({'error': 'Invalid data'}), 400
 
-    if user_book:
-        user_book.feedback = feedback
-        # Update the status if the feedback is 'accept'
-        if feedback == 'accept' and user_book.status != 'to_read':
-            user_book.status = 'to_read'
-    else:
-        # Create a new record if it doesn't exist
-        user_book = UserBooks(
-            book_id=book_id,
-            feedback=feedback,
-            status='to_read' if feedback == 'accept' else status
-        )
-        db.session.add(user_book)
+    # Queue the feedback if write-behind is enabled; it is written in the next batch
+    queue = get_feedback_queue()
+    if queue is not None:
+        # Only known books are journaled: a queued event is replayed until it is written
+        if not known_book_ids([book_id]):
+            return jsonify({'error': 'Book not found'}), 404
+        queue.submit(book_id, feedback, status)
+        return jsonify({'message': 'Feedback accepted'}), 202
 
-    db.session.commit()
+    # Update (or create) the user's record and the taste profile
+    record_feedback(book_id, feedback, status)
 
     return jsonify({'message': 'Feedback saved successfully!'})
 
 
+@api.route('/api/feedback/batch', methods=['POST'])
+def feedback_batch():
+    """
+    Handles feedback for many books in a single transaction.
+
+    Expects a JSON array of {"book_id": ..., "feedback": ..., "status": ...}
+    objects and returns one result per item, in order.
+    """
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({'error': 'Expected a JSON array of feedback items'}), 400
+
+    results = [None] * len(data)
+    items = []
+    positions = []
+    for i, item in enumerate(data):
+        if not isinstance(item, dict) or not item.get('book_id') or not item.get('feedback'):
+            results[i] = {'error': 'Invalid data'}
+            continue
+        event = (item['book_id'], item['feedback'], item.get('status', 'pending'))
+        if not all(isinstance(value, str) for value in event):
+            results[i] = {'error': 'Invalid data'}
+            continue
+        items.append(event)
+        positions.append(i)
+
+    # Queue the feedback if write-behind is enabled; it is written in the next batch
+    queue = get_feedback_queue()
+    if queue is not None:
+        known = known_book_ids([book_id for book_id, _, _ in items])
+        for i, (book_id, _, _) in zip(positions, items):
+            results[i] = {'book_id': book_id, 'result': 'queued' if book_id in known else 'not_found'}
+        # Journaled with one fsync for the whole batch
+        queue.submit_many([item for item in items if item[0] in known])
+        return jsonify({'results': results}), 202
+
+    for i, (book_id, _, _), result in zip(positions, items, apply_feedback_batch(items)):
+        results[i] = {'book_id': book_id, 'result': result}
+    db.session.commit()
+
+    return jsonify({'results': results}), 200
+
+
 @api.route('/api/recommendations', methods=['GET'])
 def get_recommendations():
     """
@@ -129,26 +320,111 @@ def get_recommendations():
     genre = request.args.get('genre', None)
     top_n = int(request.args.get('top_n', 10))
 
-    # Fetch all books
-    books = Book.query.all()
     user_books = UserBooks.query.all()  # Get all user books
 
-    # Get rejected books
-    rejected_books = [ub.book_id for ub in user_books if ub.feedback == 'reject']
+    # Rejections still waiting in the write-behind queue hold external ids
+    pending_rejected = get_catalog_snapshot().row_ids_for(pending_rejections())
 
-    # Filter out rejected books
-    valid_books = [book for book in books if book.id not in rejected_books]
-
-    # Generate recommendations using the function from recommendations.py
-    recommended_books = generate_new_recommendations(query, valid_books, user_books, genre, top_n)
+    # Generate recommendations using the function from recommendations.py, leaving out rejected books
+    recommended_books = generate_new_recommendations(query, user_books, genre, top_n, get_taste_vector(),
+                                                     pending_rejected.tolist())
 
     # Serialize recommendations
-    recommendations = []
-    for book in recommended_books:
-        recommendations.append({
+    with timed('serialize'):
+        recommendations = []
+        for book in recommended_books:
+            recommendations.append({
+                'id': book.id,
+                'title': book.title,
+                'description': book.description
+            })
+
+        return jsonify({'recommendations': recommendations})
+
+
+@api.route('/api/books/<string:book_id>/similar', methods=['GET'])
+def similar_books(book_id):
+    """
+    Get the precomputed most similar books for a book.
+    """
+    limit = request.args.get('limit', DEFAULT_K, type=int)
+
+    book = Book.query.filter_by(id=book_id).first_or_404()
+    similar = get_similar_books(book.row_id, limit)
+
+    return jsonify({'similar': [
+        {'id': book.id, 'title': book.title, 'score': score}
+        for book, score in similar
+    ]})
+
+
+def rank_for_cursor(query, genre, excluded_row_ids=()):
+    """
+    Compute a fresh ranking for ``query`` and save it behind a new cursor.
+
+    Args:
+        query (str): Search query.
+        genre (str): Genre filter.
+        excluded_row_ids (iterable, optional): Extra book row ids to leave out,
+            e.g. the books already served from an exhausted cursor.
+
+    Returns:
+        tuple: (cursor token, cursor dict).
+    """
+    user_books = UserBooks.query.filter_by(status="read").all()
+
+    ranked = rank_books(query, user_books, genre, current_app.config['RANKING_CURSOR_DEPTH'], get_taste_vector(),
+                        excluded_row_ids)
+    token = create_cursor(query, genre, [book.row_id for book in ranked], get_catalog_version(),
+                          excluded_ids=excluded_row_ids)
+    return token, load_cursor(token)
+
+
+@api.route('/api/recommendations/next', methods=['GET'])
+def next_recommendation():
+    """
+    Get the next recommendation from a ranked-result cursor.
+
+    The ranking is only recomputed when the cursor is missing, expired,
+    exhausted, older than the catalog or was computed for a different query or
+    genre than the one given; the response carries the token to use for the
+    following call.
+    """
+    token = request.args.get('cursor', '')
+    query = request.args.get('query', '').strip()
+    genre = request.args.get('genre', '').strip()
+
+    cursor = load_cursor(token)
+    if cursor is not None and (cursor['catalog_version'] != get_catalog_version()
+                               or query and (query, genre) != (cursor['query'], cursor['genre'])):
+        delete_cursor(token)
+        cursor = None
+    if cursor is None:
+        if not query:
+            return jsonify({'error': 'Query parameter is required'}), 400
+        token, cursor = rank_for_cursor(query, genre)
+
+    # Skip books rejected since the ranking was computed, including pending ones
+    rejected = rejected_row_ids()
+
+    book_row_id = advance_cursor(token, cursor, rejected)
+    if book_row_id is None:
+        # Exhausted: rank again, leaving out everything this cursor and its predecessors covered
+        delete_cursor(token)
+        covered = cursor.get('excluded_ids', []) + cursor['ranked_ids']
+        token, cursor = rank_for_cursor(cursor['query'], cursor['genre'], covered)
+        book_row_id = advance_cursor(token, cursor, rejected)
+
+    book = db.session.get(Book, book_row_id) if book_row_id else None
+    if book is None:
+        return jsonify({'book': None, 'cursor': token})
+
+    return jsonify({
+        'book': {
             'id': book.id,
             'title': book.title,
+            'author': book.author.name if book.author else None,
             'description': book.description
-        })
-
-    return jsonify({'recommendations': recommendations})
\ No newline at end of file
+        },
+        'cursor': token
+    })
@@ -23,4 +23,4 @@ class ReviewSchema(Schema):
     rating = fields.Int()
     comment = fields.Str()
     created_at = fields.DateTime()
-    book_id = fields.Str()
+    book_id = fields.Function(lambda review: review.book.id if review.book else None)
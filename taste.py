@@ -0,0 +1,118 @@
+"""
+The user's taste profile: a weighted mean of the embeddings of books they
+have read, accepted or rejected.
+
+The profile is stored as a running weighted sum plus the total absolute
+weight, so every state change is applied in O(dim) from the one book that
+changed instead of re-encoding the whole reading history.
+"""
+import logging
+import numpy as np
+from models import db, Book, UserBooks, UserProfile
+
+logger = logging.getLogger('bookhunt')
+
+# How much each kind of interaction pulls the profile towards (or away from) a book
+READ_WEIGHT = 1.0
+ACCEPT_WEIGHT = 0.5
+REJECT_WEIGHT = -0.5
+
+def book_weight(book, status, feedback):
+    """
+    Return the weight a book contributes to the taste profile in a given state.
+
+    Args:
+        book (Book): The book the state belongs to.
+        status (str): UserBooks status ('read', 'to_read', 'pending', ...).
+        feedback (str): UserBooks feedback ('accept', 'reject' or None).
+
+    Returns:
+        float: The book's weight (0 if it doesn't count towards the profile).
+    """
+    # Books without a description all share the same placeholder embedding
+    if book is None or not book.description:
+        return 0.0
+    if feedback == 'reject':
+        return REJECT_WEIGHT
+    if status == 'read':
+        return READ_WEIGHT
+    if feedback == 'accept' or status == 'to_read':
+        return ACCEPT_WEIGHT
+    return 0.0
+
+def get_profile():
+    """Return the stored taste profile, creating an empty one if needed."""
+    profile = UserProfile.query.first()
+    if profile is None:
+        profile = UserProfile(vector_sum=None, weight_total=0.0)
+        db.session.add(profile)
+    return profile
+
+def apply_taste_delta(vector_delta, weight_delta):
+    """
+    Add a change to the profile's weighted vector sum and total weight.
+
+    The change is added to the current session; the caller commits it together
+    with the UserBooks changes that caused it. Batch writers sum their changes
+    first and call this once.
+
+    Args:
+        vector_delta (np.ndarray): Change to the weighted sum of embeddings.
+        weight_delta (float): Change to the total absolute weight.
+    """
+    profile = get_profile()
+    vector_sum = profile.get_vector_sum()
+    profile.set_vector_sum(vector_delta if vector_sum is None else vector_sum + vector_delta)
+    profile.weight_total = (profile.weight_total or 0.0) + weight_delta
+
+def get_taste_vector():
+    """
+    Return the unit-length taste vector, or None if the user has no history yet.
+
+    Returns:
+        np.ndarray or None: The normalised weighted mean of the profile.
+    """
+    profile = UserProfile.query.first()
+    if profile is None or not profile.weight_total:
+        return None
+    vector_sum = profile.get_vector_sum()
+    if vector_sum is None:
+        return None
+    norm = np.linalg.norm(vector_sum)
+    return (vector_sum / norm).astype(np.float32) if norm else None
+
+def rebuild_taste_profile(embed):
+    """
+    Recompute the taste profile from scratch over all UserBooks rows.
+
+    Args:
+        embed (callable): Returns the description embeddings for a Book.
+
+    Returns:
+        tuple: (cosine similarity between the stored and rebuilt vector sums or
+        None if either is empty, stored weight total, rebuilt weight total).
+    """
+    vector_sum = None
+    weight_total = 0.0
+    rows = db.session.query(UserBooks, Book).join(Book, UserBooks.book_row_id == Book.row_id).all()
+    for user_book, book in rows:
+        weight = book_weight(book, user_book.status, user_book.feedback)
+        if not weight:
+            continue
+        contribution = weight * np.asarray(embed(book), dtype=np.float64)
+        vector_sum = contribution if vector_sum is None else vector_sum + contribution
+        weight_total += abs(weight)
+
+    profile = get_profile()
+    stored_sum = profile.get_vector_sum()
+    stored_total = profile.weight_total or 0.0
+    agreement = None
+    if stored_sum is not None and vector_sum is not None:
+        norms = np.linalg.norm(stored_sum) * np.linalg.norm(vector_sum)
+        agreement = float(np.dot(stored_sum, vector_sum) / norms) if norms else None
+
+    profile.set_vector_sum(vector_sum)
+    profile.weight_total = weight_total
+    db.session.commit()
+    logger.info('taste profile rebuilt books=%d weight_total=%.2f', len(rows), weight_total)
+    return agreement, stored_total, weight_total
@@ -0,0 +1,55 @@
+"""
+Production WSGI entry point.
+
+Run it with the bundled gunicorn config (see gunicorn.conf.py)::
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With ``preload_app`` on, this module is imported once in the gunicorn master.
+The BERT weights and the catalog snapshot are loaded here, before the
+workers are forked, so every worker shares those pages copy-on-write instead
+of loading its own ~440 MB copy.
+
+Nothing is encoded in the master: running the model starts torch's OpenMP
+thread pool, which does not survive a fork. Book embeddings come from the
+memory-mapped file built by ``flask build-embeddings``, or are encoded on
+demand by each worker without one.
+"""
+import gc
+import logging
+
+from app import app
+from models import db
+from recommendations import MODEL_NAME, load_model
+from embedding_store import get_embedding_store
+from catalog_snapshot import get_catalog_snapshot
+
+logger = logging.getLogger('bookhunt')
+
+
+def preload():
+    """Load the model weights and read-only catalog structures in the current process, without running inference."""
+    _, model = load_model()
+    model.eval()
+
+    if app.config['PRELOAD_CATALOG']:
+        with app.app_context():
+            snapshot = get_catalog_snapshot()
+            logger.info('catalog snapshot preloaded books=%d version=%d', len(snapshot), snapshot.version)
+            # The memory-mapped embedding file is shared through the page cache
+            if get_embedding_store(MODEL_NAME) is None:
+                logger.warning('no embedding file for model=%s; workers will encode books on demand '
+                               '(run flask build-embeddings)', MODEL_NAME)
+
+    # Connections must not be shared with forked workers; importing the app
+    # already opened one to check the schema
+    with app.app_context():
+        db.engine.dispose()
+
+    # Move everything loaded so far out of the GC's reach: collections in the
+    # workers would otherwise write to these objects' headers and unshare the pages
+    gc.collect()
+    gc.freeze()
+
+
+preload()